@@ -0,0 +1,136 @@
+import asyncio
+import threading
+import json
+import logging
+import aiohttp
+import requests
+from urllib.parse import urlsplit
+from requests.cookies import RequestsCookieJar, morsel_to_cookie, create_cookie, get_cookie_header
+
+logger = logging.getLogger(__file__)
+
+class AsyncResponse:
+    """ Minimal stand-in for requests.Response covering what the Scraper reads off of responses. """
+    def __init__(self, method, url, status_code, headers, content, cookies):
+        self.method = method
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        self.cookies = cookies
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8", errors="replace")
+
+    def json(self):
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        if not self.ok:
+            raise requests.HTTPError(f"{self.status_code} Error for url: {self.url}", response=self)
+
+class AsyncSession:
+    """
+    Drop-in replacement for the subset of requests.Session used by the Scraper.
+
+    Every request goes through one shared aiohttp client, which runs on its own event loop thread, so the session can be
+    used from any number of threads at once. The client pools connections, caps concurrent connections per host, and
+    applies a default timeout to every request.
+
+    Cookies are kept in a requests cookie jar (rather than aiohttp's) so that login/session pickling work unchanged.
+    """
+    def __init__(self, timeout=30, connections_per_host=8):
+        self.headers = {}
+        self.cookies = RequestsCookieJar()
+        # Cookies are read by the threads making requests and written on the event loop thread.
+        self.cookies_lock = threading.Lock()
+        self.timeout = timeout
+        self.connections_per_host = connections_per_host
+
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="async_http", daemon=True)
+        self.thread.start()
+        self.client = self.run(self.create_client())
+
+    async def create_client(self):
+        return aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit_per_host=self.connections_per_host),
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+            cookie_jar=aiohttp.DummyCookieJar()
+        )
+
+    def run(self, coro):
+        """ Run a coroutine on the session's event loop and block until it completes. """
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def build_headers(self, method, url, headers=None):
+        merged = {**self.headers, **(headers or {})}
+        # requests silently drops headers set to None, e.g. an unconfigured User-Agent.
+        merged = {k: v for (k, v) in merged.items() if v is not None}
+        with self.cookies_lock:
+            cookie_header = get_cookie_header(self.cookies, requests.Request(method.upper(), url).prepare())
+        if cookie_header:
+            merged["Cookie"] = cookie_header
+        return merged
+
+    def extract_cookies(self, url, morsels):
+        jar = RequestsCookieJar()
+        host = urlsplit(url).hostname
+        for morsel in morsels.values():
+            cookie = morsel_to_cookie(morsel)
+            if not cookie.domain:
+                cookie = create_cookie(
+                    cookie.name, cookie.value,
+                    domain=host, path=cookie.path or "/", expires=cookie.expires, secure=cookie.secure
+                )
+            jar.set_cookie(cookie)
+        with self.cookies_lock:
+            self.cookies.update(jar)
+        return jar
+
+    async def _request(self, method, url, data=None, headers=None, timeout=None, allow_redirects=True):
+        kwargs = {}
+        if timeout is not None:
+            kwargs["timeout"] = aiohttp.ClientTimeout(total=timeout)
+        try:
+            async with self.client.request(
+                method.upper(),
+                url,
+                data=data,
+                headers=self.build_headers(method, url, headers),
+                allow_redirects=allow_redirects,
+                **kwargs
+            ) as res:
+                content = await res.read()
+                # Cookies set by redirects along the way also need to be kept.
+                for prev in res.history:
+                    self.extract_cookies(str(prev.url), prev.cookies)
+                cookies = self.extract_cookies(str(res.url), res.cookies)
+                return AsyncResponse(method, str(res.url), res.status, dict(res.headers), content, cookies)
+        # Surface the same exception types as the requests engine so callers don't need to care which is in use.
+        except asyncio.TimeoutError as e:
+            raise requests.Timeout(f"Request to '{url}' timed out.") from e
+        except aiohttp.ClientError as e:
+            raise requests.ConnectionError(str(e)) from e
+
+    def request(self, method, url, **kwargs):
+        return self.run(self._request(method, url, **kwargs))
+
+    def get(self, url, **kwargs):
+        return self.request("get", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("post", url, **kwargs)
+
+    def head(self, url, **kwargs):
+        kwargs.setdefault("allow_redirects", False)
+        return self.request("head", url, **kwargs)
+
+    def close(self):
+        self.run(self.client.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
@@ -1,6 +1,41 @@
 import sys
 import os
+from sqlalchemy import func
 from db import *
+from migrations import migrate, get_migration_status, get_missing_indexes
+from drive import hash_drive_file
+
+
+""" Hash the contents of every uploaded file that doesn't have a SHA-256 yet, so new uploads can be deduplicated against it. """
+def backfill_file_hashes(session):
+    files = session.query(File).filter(
+        (File.sha256 == None) &
+        ((File.unknown == False) | (File.unknown == None))
+    ).all()
+    print(f"Hashing {len(files)} files.")
+    for (i, file) in enumerate(files):
+        try:
+            file.sha256 = hash_drive_file(file.drive_project_id, file.drive_id)
+        except Exception as e:
+            print(f"Failed to hash file {file.id} ('{file.file_name}'): {e}")
+            continue
+        # Commit periodically so an interrupted backfill doesn't lose its progress.
+        if (i + 1) % 50 == 0:
+            session.commit()
+            print(f"Hashed {i + 1}/{len(files)} files.")
+    session.commit()
+
+    duplicates = session.query(File.sha256).filter(File.sha256 != None).group_by(File.sha256).having(func.count(File.drive_id.distinct()) > 1).count()
+    print(f"Done. {duplicates} distinct files are stored on Drive more than once.")
+
+""" Print which migrations have been applied, and any indexes declared on the models that the database is missing. """
+def print_migration_status():
+    with engine.connect() as connection:
+        for (version, name, applied) in get_migration_status(connection):
+            print(f"{version:>3} {name} {'(applied)' if applied else '(pending)'}")
+        missing_indexes = get_missing_indexes(connection, Base.metadata)
+    if len(missing_indexes) > 0:
+        print(f"Indexes missing a migration: {', '.join(missing_indexes)}")
 
 
 if __name__ == "__main__":
@@ -22,5 +57,14 @@ if __name__ == "__main__":
                     for file in post.get_files():
                         print("--> " + str(file))
                     print()
+    elif args[0] == "backfill":
+        if args[1] == "hashes":
+            backfill_file_hashes(session)
+    elif args[0] == "migrate":
+        # Pending migrations are also applied whenever the database is opened.
+        migrate(engine)
+        print_migration_status()
+    elif args[0] == "status":
+        print_migration_status()
 
     session.close()
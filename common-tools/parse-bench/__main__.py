@@ -0,0 +1,48 @@
+import sys
+import os
+import glob
+import timeit
+from parsing import get_available_backends, set_backend, make_soup, Selectors
+from scraper import Scraper
+
+"""
+Micro-benchmark of listing and thread page parsing for each available HTML parser backend,
+over the saved pages in tests/mocks/requests.
+
+Usage: python common-tools/parse-bench [repeat]
+"""
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), "..", "..", "tests", "mocks", "requests", "mock_requests")
+
+def load_pages(pattern):
+    pages = []
+    for file_path in sorted(glob.glob(os.path.join(FIXTURES_DIR, pattern))):
+        with open(file_path, "rb") as f:
+            pages.append(f.read())
+    return pages
+
+def parse_listing(scraper, content):
+    soup = make_soup(content)
+    return [scraper.parse_post_data(soup, el) for el in Selectors.THREAD.select(soup)]
+
+def time_per_page(parse, pages, repeat):
+    """ Best-of-`repeat` time to parse a page, in ms. """
+    best = min(timeit.repeat(lambda: [parse(page) for page in pages], number=1, repeat=repeat))
+    return best / len(pages) * 1000
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    repeat = int(args[0]) if len(args) > 0 else 5
+
+    listing_pages = load_pages("hip_hop_leaks.html")
+    thread_pages = load_pages(os.path.join("hip_hop_leaks_posts", "*.html"))
+
+    # Parsing doesn't touch the network or the DB, so an uninitialized Scraper is enough.
+    scraper = Scraper.__new__(Scraper)
+
+    print(f"{len(listing_pages)} listing pages, {len(thread_pages)} thread pages, best of {repeat}.")
+    for backend in get_available_backends():
+        set_backend(backend)
+        listing_time = time_per_page(lambda page: parse_listing(scraper, page), listing_pages, repeat)
+        thread_time = time_per_page(scraper.parse_post_page, thread_pages, repeat)
+        print(f"{backend:<12} listing: {listing_time:8.2f} ms/page    thread: {thread_time:8.2f} ms/page")
@@ -1,12 +1,18 @@
+import json
 import jsonpickle
-from sqlalchemy import create_engine, Column, String, DateTime, Integer, Numeric, Boolean, LargeBinary
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from sqlalchemy import create_engine, event, func, select, literal_column, MetaData, Table, Column, ForeignKey, Index, String, DateTime, Integer, Numeric, Boolean, LargeBinary
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy.ext.associationproxy import association_proxy
+from sqlalchemy.ext.orderinglist import ordering_list
+from sqlalchemy.orm import sessionmaker, scoped_session, relationship, object_session
 from sqlalchemy.types import TypeDecorator, String, Unicode
 from datetime import datetime
 from commons import get_mimetype
 from drive import get_direct_url, get_file as get_drive_file
-from url_parser import URLParser
+from url_parser import HostsByName
+from migrations import migrate
+from exceptions import InvalidCursorError
 
 # Have absolutely no idea if setting check_same_thread to False is safe,
 # nor any idea what it actually does, but it's the only way for SQLAlchemy
@@ -20,12 +26,24 @@ Base = declarative_base()
 
 def session_factory():
     Base.metadata.create_all(engine)
+    migrate(engine)
     return _SessionFactory()
 
 def flask_session_factory():
     return scoped_session(session_factory)
 
-persistent_session = session_factory()
+# Full-text index of posts, created and kept up to date by triggers (see migrations.create_post_search_index). It isn't
+# part of Base's metadata since `create_all` can't create virtual tables.
+post_search = Table(
+    "post_search", MetaData(),
+    Column("rowid", Integer),
+    Column("title", String),
+    Column("body", String),
+    Column("created_by", String),
+    Column("file_names", String)
+)
+# Weights of the indexed columns (title, body, created_by, file_names) when ranking search results.
+SEARCH_WEIGHTS = (10.0, 1.0, 5.0, 5.0)
 
 class JsonType(TypeDecorator):
     impl = Unicode
@@ -41,12 +59,23 @@ class JsonType(TypeDecorator):
 
 class Post(Base):
     __tablename__ = "posts"
+    __table_args__ = (
+        # Section listings, one index per sort order (see POST_SORT_COLUMNS).
+        Index("ix_posts_section_created", "section_id", "pinned", "created", "id"),
+        Index("ix_posts_section_view_count", "section_id", "pinned", "view_count", "id"),
+        Index("ix_posts_section_reply_count", "section_id", "pinned", "reply_count", "id"),
+        # Posts by an author, and the most recently scraped posts.
+        Index("ix_posts_created_by", "created_by"),
+        Index("ix_posts_first_scraped", "first_scraped")
+    )
 
     id = Column(Integer, primary_key=True)
     native_id = Column(String, unique=True, nullable=False)
     section_id = Column(Integer, nullable=False)
     title = Column(String, nullable=False)
     url = Column(String, nullable=False)
+    # The prefix names, also stored one row per prefix in `post_prefixes` (see PostPrefix) so posts can be filtered by
+    # prefix with an index. Setting `prefixes` updates the rows.
     prefixes = Column(JsonType())
     prefix = Column(String)
     created_by = Column(String, nullable=False)
@@ -57,10 +86,35 @@ class Post(Base):
     html = Column(String, nullable=False)
     pinned = Column(Boolean, nullable=False)
     deleted = Column(Boolean)
+    last_checked_deleted = Column(DateTime)
+    # Fingerprint of the listing data last written to the post (see Scraper.get_post_fingerprint).
+    fingerprint = Column(String)
 
     first_scraped = Column(DateTime, default=datetime.now)
     last_updated = Column(DateTime, default=datetime.now)
 
+    # Files are created by post_id (see Scraper.create_file), so the relationship is only used for loading them.
+    # Use `subqueryload(Post.files)` when loading several posts that will be serialized.
+    files = relationship(
+        "File",
+        primaryjoin="Post.id == foreign(File.post_id)",
+        order_by="File.id",
+        viewonly=True
+    )
+
+    prefix_entries = relationship(
+        "PostPrefix",
+        order_by="PostPrefix.position",
+        collection_class=ordering_list("position"),
+        cascade="all, delete-orphan"
+    )
+    prefix_names = association_proxy("prefix_entries", "name", creator=lambda name: PostPrefix(name=name))
+
+    @classmethod
+    def has_prefix(cls, prefix_name):
+        """ Filter criterion for posts with the given prefix. """
+        return cls.id.in_(select([PostPrefix.post_id]).where(PostPrefix.name == prefix_name))
+
     def get_files(self):
         return persistent_session.query(File).filter_by(post_id=self.id)
 
@@ -68,22 +122,27 @@ class Post(Base):
         return persistent_session.query(Prefix).filter_by(name=prefix_name).first()
 
     def delete(self):
-        for file in self.get_files():
-            if not file.unknown:
+        for file in self.get_files().all():
+            # Drive files are deduplicated by content, so only delete the Drive file if no other post uses it.
+            if not file.unknown and not file.is_drive_file_shared():
                 drive_file = get_drive_file(file.drive_project_id, file.drive_id)
                 drive_file.Delete()
             persistent_session.delete(file)
         persistent_session.delete(self)
         persistent_session.commit()
 
-    def serialize(self):
+    def serialize(self, prefixes=None):
+        """ `prefixes` maps prefix names to Prefix objects (see get_prefix_map). If not given, the post's prefixes are
+            looked up in a single query. """
+        if prefixes is None:
+            prefixes = get_prefix_map(object_session(self) or persistent_session, self.prefixes or [])
         return {
             "id": self.id,
             "native_id": self.native_id,
             "section_id": self.section_id,
             "title": self.title,
             "url": self.url,
-            "prefixes": [self.get_prefix(prefix).serialize() for prefix in self.prefixes],
+            "prefixes": [prefixes[prefix].serialize() for prefix in self.prefixes or [] if prefix in prefixes],
             # "prefix": prefix.serialize() if prefix is not None else None,
             "created_by": self.created_by,
             "created": self.created.timestamp(),
@@ -94,33 +153,69 @@ class Post(Base):
             "pinned": self.pinned,
             "deleted": self.deleted,
 
-            "files": [f.serialize() for f in self.get_files()],
+            "files": [f.serialize() for f in self.files],
 
             "first_scraped": self.first_scraped.timestamp(),
             "last_updated": self.last_updated.timestamp()
         }
 
     def __repr__(self):
-        return f"<Post('{self.title}', '{self.get_files().count()} urls')>"
+        # Loaded through the post's own session rather than `persistent_session`, which belongs to the scraper thread.
+        return f"<Post('{self.title}', '{len(self.files)} urls')>"
+
+@event.listens_for(Post.prefixes, "set")
+def sync_prefix_entries(post, prefixes, old_prefixes, initiator):
+    # Posts are reassigned their listing's prefixes on every update, which usually haven't changed.
+    if prefixes == old_prefixes: return
+    post.prefix_names = [prefix for prefix in prefixes or [] if prefix is not None]
+
+class PostPrefix(Base):
+    __tablename__ = "post_prefixes"
+    __table_args__ = (
+        # Posts with a prefix, and a post's prefixes.
+        Index("ix_post_prefixes_name_post_id", "name", "post_id"),
+        Index("ix_post_prefixes_post_id_position", "post_id", "position")
+    )
+
+    id = Column(Integer, primary_key=True)
+    post_id = Column(Integer, ForeignKey("posts.id"), nullable=False)
+    name = Column(String, nullable=False)
+    position = Column(Integer, nullable=False)
+
+    def __repr__(self):
+        return f"PostPrefix<'{self.post_id}', '{self.name}'>"
 
 class File(Base):
     __tablename__ = "files"
+    __table_args__ = (
+        # A post's files.
+        Index("ix_files_post_id", "post_id"),
+        # Unknown files due to be retried (see RetryScheduler.get_due_files).
+        Index("ix_files_unknown_next_attempt_at", "unknown", "next_attempt_at"),
+        # Files per hosting service.
+        Index("ix_files_hosting_service_first_scraped", "hosting_service", "first_scraped")
+    )
 
     id = Column(Integer, primary_key=True)
     post_id = Column(Integer, nullable=False)
-    url = Column(String, nullable=False)
+    url = Column(String, nullable=False, index=True)
     download_url = Column(String, nullable=False)
     file_name = Column(String, nullable=False)
     file_size = Column(Integer, nullable=False)
+    # Name of the hosting service. Empty if the URL doesn't belong to a supported hosting service.
     hosting_service = Column(String, nullable=False)
     drive_id = Column(String, nullable=False)
     drive_project_id = Column(String, nullable=False)
+    # SHA-256 of the file's contents. Files with the same contents share a single Drive file.
+    sha256 = Column(String, index=True)
     cover = Column(LargeBinary)
     # Only set on files that weren't properly downloaded.
     unknown = Column(Boolean)
     exception = Column(String)
     traceback = Column(String)
     retries = Column(Integer, default=0)
+    # When an unknown file is next due to be retried (see RetryScheduler).
+    next_attempt_at = Column(DateTime)
     first_scraped = Column(DateTime, default=datetime.now)
     last_updated = Column(DateTime, default=datetime.now)
 
@@ -128,7 +223,16 @@ class File(Base):
         return persistent_session.query(Post).filter_by(id=self.post_id).first()
 
     def get_hosting_service(self):
-        return URLParser().get_hosting_service(self.url)
+        # The hosting service is resolved when the file is scraped, so there's no need to match the URL again.
+        return HostsByName.get(self.hosting_service)
+
+    def is_drive_file_shared(self):
+        """ Whether any other file (on this post or another) points to the same Drive file. """
+        return persistent_session.query(File).filter(
+            (File.drive_project_id == self.drive_project_id) &
+            (File.drive_id == self.drive_id) &
+            (File.id != self.id)
+        ).first() is not None
 
     def serialize(self):
         hosting_service = self.get_hosting_service()
@@ -154,7 +258,8 @@ class File(Base):
 
     def __repr__(self):
         hosting_service = self.get_hosting_service()
-        return f"File<'{self.get_post().title}', '{hosting_service.name if hosting_service else None}', '{self.file_name}'>"
+        # Files are logged from worker threads (e.g. by the retry scheduler), so this mustn't query `persistent_session`.
+        return f"File<'post {self.post_id}', '{hosting_service.name if hosting_service else None}', '{self.file_name}'>"
 
 class Prefix(Base):
     __tablename__ = "prefix"
@@ -180,4 +285,81 @@ class Prefix(Base):
         }
 
     def __repr__(self):
-        return f"Prefix<'{self.name}', '{self.bg_color}'>"
\ No newline at end of file
+        return f"Prefix<'{self.name}', '{self.bg_color}'>"
+
+# Columns posts are sorted by (descending, then by descending id) for each sort order of the section listing.
+POST_SORT_COLUMNS = {
+    "latest": Post.created,
+    "popular": Post.view_count,
+    "active": Post.reply_count
+}
+
+# Created once every model is defined, so that `create_all` creates their tables before any migrations are applied.
+persistent_session = session_factory()
+
+def get_prefix_map(session, prefix_names):
+    """ Map each of the prefix names to its Prefix. """
+    prefix_names = set(prefix_names)
+    if len(prefix_names) == 0:
+        return {}
+    prefixes = {}
+    # Keep the first prefix with a given name, like Post.get_prefix.
+    for prefix in session.query(Prefix).filter(Prefix.name.in_(prefix_names)).order_by(Prefix.id.desc()):
+        prefixes[prefix.name] = prefix
+    return prefixes
+
+def get_prefix_post_counts(session):
+    """ Map each prefix name to the number of posts with that prefix. """
+    return dict(
+        session.query(PostPrefix.name, func.count(PostPrefix.post_id.distinct())).group_by(PostPrefix.name)
+    )
+
+def serialize_posts(session, posts):
+    """ Serialize posts, looking up all of their prefixes in a single query. The posts' files should already be loaded,
+        i.e. the posts were queried with `.options(subqueryload(Post.files))`. """
+    prefixes = get_prefix_map(session, [prefix for post in posts for prefix in post.prefixes or []])
+    return [post.serialize(prefixes) for post in posts]
+
+def has_search_index(session):
+    return session.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='post_search'").first() is not None
+
+def get_search_terms(query):
+    """ FTS5 query matching every word of `query`, the last one as a prefix since queries come from a search box.
+        Words are quoted so they're never parsed as FTS5 syntax. """
+    words = ['"' + word.replace('"', '""') + '"' for word in query.split()]
+    if len(words) > 0:
+        words[-1] += "*"
+    return " ".join(words)
+
+def search_posts(session, query):
+    """ Subquery of the `post_id` and `rank` (lower is more relevant) of the posts matching `query`, or None if the
+        full-text index isn't available. """
+    if not has_search_index(session):
+        return None
+    table = literal_column("post_search")
+    return select([
+        post_search.c.rowid.label("post_id"),
+        func.bm25(table, *SEARCH_WEIGHTS).label("rank")
+    ]).where(table.op("MATCH")(get_search_terms(query))).alias("search")
+
+def get_post_cursor(post, sort_by):
+    """ Cursor for the posts after `post` when sorted by `sort_by` (see filter_after_cursor). """
+    value = getattr(post, POST_SORT_COLUMNS[sort_by].key)
+    if isinstance(value, datetime):
+        value = value.isoformat()
+    return urlsafe_b64encode(json.dumps([sort_by, value, post.id]).encode()).decode()
+
+def filter_after_cursor(query, sort_by, cursor):
+    """ Keyset pagination: filter a query sorted by `sort_by` to the posts after the cursor. Unlike an offset, the
+        index on the sort column is used to seek straight to the cursor, however deep the page is. """
+    column = POST_SORT_COLUMNS[sort_by]
+    try:
+        (cursor_sort_by, value, post_id) = json.loads(urlsafe_b64decode(cursor.encode()))
+        if cursor_sort_by != sort_by:
+            raise ValueError(f"Cursor is for sorting by '{cursor_sort_by}'.")
+        value = datetime.fromisoformat(value) if column is Post.created else int(value)
+        post_id = int(post_id)
+    except (ValueError, TypeError) as e:
+        raise InvalidCursorError(cursor) from e
+    # Equivalent to (column, id) < (value, post_id), but lets SQLite seek on the column.
+    return query.filter((column <= value) & ((column < value) | (Post.id < post_id)))
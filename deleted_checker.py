@@ -0,0 +1,79 @@
+import logging
+import math
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from db import Post
+
+logger = logging.getLogger(__file__)
+
+class DeletedPostChecker:
+    """
+    Checks whether archived posts have been deleted from the site.
+
+    Every post among the `check_deleted_depth` most recent is rechecked about once every `check_deleted_interval` minutes.
+    Rather than checking all of them in one burst, each run only checks the share of posts that has come due since
+    the previous run (stalest first), so the work is spread evenly over time. Checks are HEAD requests issued in parallel.
+    """
+    def __init__(self, scraper):
+        self.scraper = scraper
+        self.last_run = None
+
+    @property
+    def config(self):
+        return self.scraper.config
+
+    def get_batch_size(self, now):
+        depth = self.config["check_deleted_depth"]
+        interval = timedelta(minutes=self.config["check_deleted_interval"])
+        if self.last_run is None or interval.total_seconds() == 0:
+            return depth
+        return math.ceil(depth * min((now - self.last_run) / interval, 1))
+
+    def get_due_posts(self, session, now, batch_size):
+        interval = timedelta(minutes=self.config["check_deleted_interval"])
+        recent = session.query(Post.id).order_by(Post.created.desc()).limit(self.config["check_deleted_depth"]).subquery()
+        return session.query(Post).filter(
+            Post.id.in_(recent) &
+            ((Post.deleted == False) | (Post.deleted == None)) &
+            ((Post.last_checked_deleted == None) | (Post.last_checked_deleted < now - interval))
+        # SQLite sorts NULLs first, so posts that have never been checked go first.
+        ).order_by(Post.last_checked_deleted.asc()).limit(batch_size).all()
+
+    def is_deleted(self, url):
+        timeout = self.config["check_deleted_timeout"]
+        # Threads can redirect to a removal page that 404s, like the GET this replaced would have followed.
+        res = self.scraper.session.head(url, timeout=timeout, allow_redirects=True)
+        if res.status_code in (405, 501):
+            # HEAD isn't supported, fall back to a GET for as little of the page as possible.
+            res = self.scraper.session.get(url, headers={"Range": "bytes=0-0"}, timeout=timeout)
+        return res.status_code in (404, 410)
+
+    def run(self):
+        now = datetime.now()
+        batch_size = self.get_batch_size(now)
+        self.last_run = now
+        if batch_size == 0: return
+
+        session = self.scraper.create_db_session()
+        posts = self.get_due_posts(session, now, batch_size)
+        logger.info(f"Checking {len(posts)} posts for deletion.")
+
+        def check(post):
+            try:
+                return self.is_deleted(post.url)
+            except Exception as e:
+                logger.warning(f"Could not check if post \"{post.title}\" is deleted: {e}")
+                return None
+
+        with ThreadPoolExecutor(max_workers=self.config["check_deleted_workers"], thread_name_prefix="deleted_checker") as executor:
+            results = list(executor.map(check, posts))
+
+        for (post, deleted) in zip(posts, results):
+            # Failed checks are retried next run.
+            if deleted is None: continue
+            post.last_checked_deleted = now
+            if deleted:
+                logger.info(f"Marking post \"{post.title}\" as deleted.")
+                post.deleted = True
+        session.commit()
+        session.close()
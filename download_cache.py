@@ -0,0 +1,109 @@
+import logging
+import threading
+import weakref
+from collections import OrderedDict
+from sqlalchemy import event
+from db import session_factory, File
+
+logger = logging.getLogger(__file__)
+
+class DownloadCache:
+    """
+    Resolves hosting URLs that have already been archived, so a reposted link reuses the existing files instead of
+    being downloaded and uploaded again.
+
+    Resolved URLs are kept in an in-memory LRU of `max_size` entries. On a miss, the (indexed) `File.url` column is
+    checked for a post where every file behind the URL was archived successfully. Entries are evicted when one of their
+    files is deleted.
+    """
+    def __init__(self, max_size=4096):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        instances.add(self)
+
+    def set_max_size(self, max_size):
+        with self.lock:
+            self.max_size = max_size
+            self.evict()
+
+    def forget(self, url):
+        with self.lock:
+            self.entries.pop(url, None)
+
+    def evict(self):
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    @staticmethod
+    def serialize_file(file):
+        return {
+            "url": file.url,
+            "download_url": file.download_url,
+            "file_name": file.file_name,
+            "file_size": file.file_size,
+            "sha256": file.sha256,
+            "hosting_service": file.hosting_service,
+            "drive_id": file.drive_id,
+            "drive_project_id": file.drive_project_id,
+            "cover": file.cover
+        }
+
+    def lookup(self, url):
+        session = session_factory()
+        try:
+            files = session.query(File).filter_by(url=url).order_by(File.post_id, File.id).all()
+        finally:
+            session.close()
+        # A URL can point to several files (e.g. a GoFile folder), so take all the files from the first post that
+        # archived every one of them.
+        posts = OrderedDict()
+        for file in files:
+            posts.setdefault(file.post_id, []).append(file)
+        for post_files in posts.values():
+            if all([not file.unknown for file in post_files]):
+                return [self.serialize_file(file) for file in post_files]
+        return None
+
+    def get(self, url):
+        """ Files (in the format returned by `Scraper.upload_download`) already archived for `url`, or None. """
+        with self.lock:
+            files = self.entries.get(url)
+            if files is not None:
+                self.entries.move_to_end(url)
+        if files is None:
+            files = self.lookup(url)
+            if files is not None:
+                self.put(url, files)
+        with self.lock:
+            if files is not None: self.hits += 1
+            else: self.misses += 1
+        # Callers get their own copies so they can't modify the cached entries.
+        return [dict(file) for file in files] if files is not None else None
+
+    def put(self, url, files):
+        """ Cache the files downloaded from `url`. Nothing is cached if any of them couldn't be downloaded. """
+        if len(files) == 0 or any([file.get("unknown") for file in files]): return
+        with self.lock:
+            self.entries[url] = [dict(file) for file in files]
+            self.entries.move_to_end(url)
+            self.evict()
+
+    def get_stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups > 0 else None,
+                "size": len(self.entries)
+            }
+
+instances = weakref.WeakSet()
+
+@event.listens_for(File, "after_delete")
+def forget_deleted_file(mapper, connection, file):
+    for download_cache in list(instances):
+        download_cache.forget(file.url)
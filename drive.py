@@ -3,16 +3,23 @@ import traceback
 import os
 import json
 import glob
+import random
+import hashlib
+import socket
+import threading
 import portalocker
+from time import sleep, time
 from pydrive.auth import GoogleAuth, ServiceAccountCredentials
 from pydrive.drive import GoogleDrive
-from httplib2 import Http
+from httplib2 import Http, HttpLib2Error
 from apiclient.discovery import build
+from apiclient.http import MediaIoBaseUpload, MediaIoBaseDownload
+from apiclient.errors import HttpError
 from io import BytesIO
 from itertools import chain
 from dotenv import load_dotenv
 from commons import get_env_var
-from exceptions import MissingEnvironmentError, AuthenticationError, StorageError
+from exceptions import MissingEnvironmentError, AuthenticationError, StorageError, ConfigError
 
 load_dotenv()
 
@@ -31,6 +38,38 @@ except MissingEnvironmentError:
     DRIVE_STORAGE_CUTOFF = ".975"
 DRIVE_STORAGE_CUTOFF = float(DRIVE_STORAGE_CUTOFF)
 
+# Files are uploaded to Drive in chunks of DRIVE_UPLOAD_CHUNK_SIZE bytes (must be a multiple of 256 KiB).
+try:
+    DRIVE_UPLOAD_CHUNK_SIZE = get_env_var("DRIVE_UPLOAD_CHUNK_SIZE")
+except MissingEnvironmentError:
+    DRIVE_UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+DRIVE_UPLOAD_CHUNK_SIZE = int(DRIVE_UPLOAD_CHUNK_SIZE)
+if DRIVE_UPLOAD_CHUNK_SIZE <= 0 or DRIVE_UPLOAD_CHUNK_SIZE % (256 * 1024) != 0:
+    raise ConfigError(f"DRIVE_UPLOAD_CHUNK_SIZE must be a multiple of 256 KiB (262144 bytes), got {DRIVE_UPLOAD_CHUNK_SIZE}.")
+
+# A chunk that fails with a transient error is retried up to DRIVE_UPLOAD_RETRIES times before the upload is abandoned.
+try:
+    DRIVE_UPLOAD_RETRIES = get_env_var("DRIVE_UPLOAD_RETRIES")
+except MissingEnvironmentError:
+    DRIVE_UPLOAD_RETRIES = 5
+DRIVE_UPLOAD_RETRIES = int(DRIVE_UPLOAD_RETRIES)
+
+RETRYABLE_STATUS_CODES = [429, 500, 502, 503, 504]
+# Drive reports rate limiting as a 403 with one of these reasons, rather than as a 429.
+RETRYABLE_403_REASONS = ["rateLimitExceeded", "userRateLimitExceeded"]
+
+# Uploads are added to the storage cache locally. A project's cached usage is reconciled with Drive (GetAbout) once it is
+# older than DRIVE_QUOTA_RECONCILE_INTERVAL seconds, or on every upload once it is within
+# DRIVE_QUOTA_RECONCILE_MARGIN of the storage cutoff.
+try:
+    DRIVE_QUOTA_RECONCILE_INTERVAL = get_env_var("DRIVE_QUOTA_RECONCILE_INTERVAL")
+except MissingEnvironmentError:
+    DRIVE_QUOTA_RECONCILE_INTERVAL = 3600
+DRIVE_QUOTA_RECONCILE_INTERVAL = float(DRIVE_QUOTA_RECONCILE_INTERVAL)
+DRIVE_QUOTA_RECONCILE_MARGIN = .01
+
+storage_cache_lock = threading.Lock()
+
 def load_storage_cache():
     try:
         with portalocker.Lock("drive_storage_cache.json", "r") as fh:
@@ -39,6 +78,11 @@ def load_storage_cache():
         # If the file doesn't exist yet, create the cache and populate it.
         cache = update_storage_cache({})
     
+    # Populate projects that were added since the cache was created.
+    missing_ids = [project_id for project_id in get_drive_project_ids() if project_id not in cache]
+    for project_id in missing_ids:
+        update_storage_cache(cache, project_id)
+
     return cache
 
 def update_storage_cache(cache, project_id=None):
@@ -48,17 +92,36 @@ def update_storage_cache(cache, project_id=None):
         [quota_used, quota_total] = get_storage_quota(project_id)
         cache[project_id] = {
             "quota_used": quota_used,
-            "quota_total": quota_total
+            "quota_total": quota_total,
+            "last_reconciled": time()
         }
     save_storage_cache(cache)
     return cache
 
+""" Whether a project's cached storage usage should be checked against Drive. """
+def needs_reconciliation(quota):
+    if time() - quota.get("last_reconciled", 0) >= DRIVE_QUOTA_RECONCILE_INTERVAL:
+        return True
+    return quota["quota_used"] / quota["quota_total"] >= DRIVE_STORAGE_CUTOFF - DRIVE_QUOTA_RECONCILE_MARGIN
+
+""" Account for `size` bytes uploaded to a project in the storage cache, reconciling it with Drive if it's due. """
+def record_upload(project_id, size):
+    with storage_cache_lock:
+        cache = load_storage_cache()
+        quota = cache[project_id]
+        quota["quota_used"] += size
+        if needs_reconciliation(quota):
+            update_storage_cache(cache, project_id)
+        else:
+            save_storage_cache(cache)
+
 def save_storage_cache(cache):
     with portalocker.Lock("drive_storage_cache.json", "w+") as fh:
         json.dump(cache, fh)
 
-def get_drive_credential_paths():
-    value = get_env_var("DRIVE_CREDENTIALS_FILE")
+def get_drive_credential_paths(value=None):
+    if value is None:
+        value = get_env_var("DRIVE_CREDENTIALS_FILE")
     
     glob_expressions = value.split(",")
     # Get lists of file paths and flatten.
@@ -76,21 +139,44 @@ def get_project_id(path):
         except (json.JSONDecodeError, KeyError) as e:
             raise AuthenticationError(f"Invalid JSON key file with path '{path}'.")
 
+"""
+Process-wide registry of Drive clients.
+
+Key files are only globbed and parsed when DRIVE_CREDENTIALS_FILE changes, at which point the project_id -> path
+index is rebuilt and every cached client is discarded. Clients are created the first time a project is used and
+shared by every thread afterwards (PyDrive creates a new Http object for each API call, so a client is safe to share).
+"""
+drive_registry_lock = threading.RLock()
+drive_registry = {
+    "credentials_file": None,
+    "credential_paths": {},
+    "clients": {}
+}
+
+""" Get the project_id -> key file path index for the current value of DRIVE_CREDENTIALS_FILE. """
+def get_credential_index():
+    value = get_env_var("DRIVE_CREDENTIALS_FILE")
+    with drive_registry_lock:
+        if drive_registry["credentials_file"] != value:
+            credential_paths = {}
+            for path in get_drive_credential_paths(value):
+                credential_paths[get_project_id(path)] = path
+            drive_registry["credential_paths"] = credential_paths
+            drive_registry["clients"] = {}
+            drive_registry["credentials_file"] = value
+        return drive_registry["credential_paths"]
+
 """ Get the path for a key file from its project_id.
     - Validates that every key file exists, is valid JSON, and has a project_id key.
     - Does not validate whether or not each file is a valid key file (use get_drive). """
 def get_drive_credential_path(project_id):
-    paths = get_drive_credential_paths()
-    for path in paths:
-        if get_project_id(path) == project_id:
-            key_file_path = path
     try:
-        return key_file_path
-    except NameError:
+        return get_credential_index()[project_id]
+    except KeyError:
         raise AuthenticationError(f"Could not locate JSON key file with Project ID '{project_id}'.")
 
 def get_drive_project_ids():
-    return [get_project_id(path) for path in get_drive_credential_paths()]
+    return list(get_credential_index().keys())
     
 
 """ Get a pydrive.GoogleDrive instance from a project_id.
@@ -99,10 +185,27 @@ def get_drive_project_ids():
     - each key file is valid JSON
     - key file corresponding to`project_id` is a valid key file. """
 def get_drive(project_id):
-    gauth = GoogleAuth()
-    scopes = ["https://www.googleapis.com/auth/drive"]
-    gauth.credentials = ServiceAccountCredentials.from_json_keyfile_name(get_drive_credential_path(project_id), scopes)
-    drive = GoogleDrive(gauth)
+    with drive_registry_lock:
+        key_file_path = get_drive_credential_path(project_id)
+        credentials_file = drive_registry["credentials_file"]
+        drive = drive_registry["clients"].get(project_id)
+    # Authorizing and refreshing tokens go over the network, so they happen outside the lock to avoid
+    # serializing every project's first upload behind each other.
+    if drive is None:
+        gauth = GoogleAuth()
+        scopes = ["https://www.googleapis.com/auth/drive"]
+        gauth.credentials = ServiceAccountCredentials.from_json_keyfile_name(key_file_path, scopes)
+        # Build the API service up front rather than letting concurrent API calls race to build it.
+        gauth.Authorize()
+        drive = GoogleDrive(gauth)
+        with drive_registry_lock:
+            # If another thread registered a client in the meantime, share theirs. Clients created from key
+            # files that have since been replaced are used for this call only.
+            if drive_registry["credentials_file"] == credentials_file:
+                drive = drive_registry["clients"].setdefault(project_id, drive)
+    elif drive.auth.access_token_expired:
+        # PyDrive would fall back to an interactive login for an expired token, so refresh it here instead.
+        drive.auth.credentials.refresh(Http())
     return drive
 
 def get_inactive_project_ids():
@@ -128,19 +231,75 @@ def get_active_project_id():
 def get_active_drive():
     return get_drive(get_active_project_id())
 
-def upload_file(file_name, stream):
-    project_id = get_active_project_id()
+""" Upload a file to Drive using a resumable upload session. Uses the active project unless `project_id` is given.
+    `stream` can be bytes or a readable file object (e.g. a SpooledDownload), which is read one chunk at a time.
+    Uploads don't share any connection state, so several can be in flight at once (to the same or different projects). """
+def upload_file(file_name, stream, project_id=None):
+    if project_id is None:
+        project_id = get_active_project_id()
     drive = get_drive(project_id)
-    file = drive.CreateFile({"title": file_name})
-    file.content = BytesIO(stream)
-    file.Upload()
+    if isinstance(stream, bytes):
+        stream = BytesIO(stream)
+    media = MediaIoBaseUpload(stream, "application/octet-stream", chunksize=DRIVE_UPLOAD_CHUNK_SIZE, resumable=True)
+    request = drive.auth.service.files().insert(body={"title": file_name}, media_body=media)
+    # httplib2 connections aren't thread-safe, so every upload is sent over its own.
+    metadata = run_resumable_upload(request, drive.auth.Get_Http_Object(), file_name)
+    file = drive.CreateFile({"id": metadata["id"]})
     file.InsertPermission({
         "type": "anyone",
         "value": "anyone",
         "role": "reader"
     })
-    update_storage_cache(load_storage_cache())
-    return (project_id, file["id"])
+    record_upload(project_id, media.size())
+    return (project_id, metadata["id"])
+
+""" Send the chunks of a resumable upload request until it completes, returning the file's metadata.
+    When a chunk fails, googleapiclient puts the request in an error state and the next call to `next_chunk` asks
+    Drive for the last byte it acknowledged, so the upload resumes from there instead of starting over. """
+def run_resumable_upload(request, http, file_name):
+    failures = 0
+    response = None
+    while response is None:
+        try:
+            (status, response) = request.next_chunk(http=http)
+            failures = 0
+            if status is not None:
+                logger.debug(f"Uploaded {status.resumable_progress}/{status.total_size} bytes of '{file_name}'.")
+        except HttpError as e:
+            if e.resp.status == 404 and request.resumable_uri is not None:
+                # The upload session expired, so it has to be restarted from the beginning.
+                logger.warning(f"Upload session for '{file_name}' expired. Restarting upload.")
+                request.resumable_uri = None
+                request.resumable_progress = 0
+                request._in_error_state = False
+            elif not is_retryable_http_error(e):
+                raise e
+            failures = wait_for_upload_retry(file_name, failures, e)
+        except (HttpLib2Error, socket.error) as e:
+            failures = wait_for_upload_retry(file_name, failures, e)
+    return response
+
+def get_http_error_reason(e):
+    try:
+        return json.loads(e.content.decode())["error"]["errors"][0]["reason"]
+    except (ValueError, KeyError, IndexError, TypeError, AttributeError):
+        return None
+
+def is_retryable_http_error(e):
+    if e.resp.status == 403:
+        return get_http_error_reason(e) in RETRYABLE_403_REASONS
+    return e.resp.status in RETRYABLE_STATUS_CODES
+
+def wait_for_upload_retry(file_name, failures, e):
+    failures += 1
+    if failures > DRIVE_UPLOAD_RETRIES:
+        logger.error(f"Giving up on uploading '{file_name}' after {failures} failed attempts.")
+        raise e
+    # Exponential backoff with jitter.
+    delay = min(2 ** failures, 64) + random.random()
+    logger.warning(f"Upload of '{file_name}' failed ({e}). Retrying in {round(delay, 1)}s (attempt {failures}).")
+    sleep(delay)
+    return failures
 
 
 def get_file(project_id, id):
@@ -148,6 +307,26 @@ def get_file(project_id, id):
     file = drive.CreateFile({"id": id})
     return file
 
+class HashWriter:
+    """ Write-only file object that hashes whatever is written to it. """
+    def __init__(self):
+        self.hash = hashlib.sha256()
+    def write(self, data):
+        self.hash.update(data)
+        return len(data)
+
+""" SHA-256 of a Drive file's contents. The file is streamed in chunks rather than loaded into memory. """
+def hash_drive_file(project_id, id):
+    drive = get_drive(project_id)
+    request = drive.auth.service.files().get_media(fileId=id)
+    request.http = drive.auth.Get_Http_Object()
+    writer = HashWriter()
+    downloader = MediaIoBaseDownload(writer, request, chunksize=DRIVE_UPLOAD_CHUNK_SIZE)
+    done = False
+    while not done:
+        (_, done) = downloader.next_chunk(num_retries=DRIVE_UPLOAD_RETRIES)
+    return writer.hash.hexdigest()
+
 def get_direct_url(project_id, id):
     drive = get_drive(project_id)
     file = drive.CreateFile({"id": id})
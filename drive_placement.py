@@ -0,0 +1,114 @@
+import logging
+import random
+import threading
+from time import time
+from drive import upload_file, load_storage_cache, get_available_project_ids, DRIVE_STORAGE_CUTOFF
+from exceptions import StorageError
+
+logger = logging.getLogger(__file__)
+
+# Smoothing factor of the per-project error rate and upload speed averages (higher reacts faster).
+EWMA_ALPHA = .2
+# A project's weight is never scaled below this by its error rate, so a project that has recovered still gets the
+# occasional upload needed to bring its error rate back down.
+MIN_HEALTH = .05
+
+class ProjectStats:
+    def __init__(self):
+        self.in_flight = 0
+        # Exponentially weighted moving averages of upload failures (0-1) and seconds spent per MiB uploaded.
+        self.error_rate = 0
+        self.seconds_per_mib = None
+
+    def record(self, failed, elapsed=None, size=None):
+        self.error_rate = EWMA_ALPHA * int(failed) + (1 - EWMA_ALPHA) * self.error_rate
+        if not failed and size:
+            seconds_per_mib = elapsed / (size / (1024 * 1024))
+            if self.seconds_per_mib is None:
+                self.seconds_per_mib = seconds_per_mib
+            else:
+                self.seconds_per_mib = EWMA_ALPHA * seconds_per_mib + (1 - EWMA_ALPHA) * self.seconds_per_mib
+
+class DrivePlacement:
+    """
+    Spreads uploads across every Drive project under the storage cutoff, rather than filling them up one at a time.
+
+    Each upload goes to a project picked at random, weighted by the project's remaining quota and scaled down by its
+    recent error rate and upload speed. At most `uploads_per_project` uploads run against a project at once, so with
+    enough upload workers, uploads to different projects run concurrently while projects with free slots are preferred.
+    """
+    def __init__(self, uploads_per_project=2):
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.semaphores = {}
+        self.uploads_per_project = uploads_per_project
+
+    def set_uploads_per_project(self, uploads_per_project):
+        with self.lock:
+            if uploads_per_project != self.uploads_per_project:
+                # Uploads already holding a slot release it on the old semaphore.
+                self.semaphores = {}
+                self.uploads_per_project = uploads_per_project
+
+    def get_stats(self, project_id):
+        stats = self.stats.get(project_id)
+        if stats is None:
+            stats = self.stats[project_id] = ProjectStats()
+        return stats
+
+    def get_semaphore(self, project_id):
+        semaphore = self.semaphores.get(project_id)
+        if semaphore is None:
+            semaphore = self.semaphores[project_id] = threading.BoundedSemaphore(self.uploads_per_project)
+        return semaphore
+
+    def get_weights(self, storage_cache, project_ids, size=0):
+        """ Weight of each project that has room for `size` bytes under the storage cutoff. """
+        speeds = [stats.seconds_per_mib for stats in self.stats.values() if stats.seconds_per_mib]
+        typical_seconds_per_mib = sum(speeds) / len(speeds) if len(speeds) > 0 else None
+        weights = {}
+        for project_id in project_ids:
+            quota = storage_cache[project_id]
+            remaining = quota["quota_total"] * DRIVE_STORAGE_CUTOFF - quota["quota_used"] - size
+            if remaining <= 0: continue
+            stats = self.get_stats(project_id)
+            weight = remaining * max(1 - stats.error_rate, MIN_HEALTH)
+            if stats.seconds_per_mib and typical_seconds_per_mib:
+                # Projects that upload slower than average get proportionally fewer uploads.
+                weight *= min(typical_seconds_per_mib / stats.seconds_per_mib, 1)
+            weights[project_id] = weight
+        return weights
+
+    def choose_project(self, size=0):
+        storage_cache = load_storage_cache()
+        with self.lock:
+            weights = self.get_weights(storage_cache, get_available_project_ids(), size)
+            if len(weights) == 0:
+                raise StorageError(f"No Drive project has room for a file of {size} bytes under the storage cutoff of {DRIVE_STORAGE_CUTOFF * 100}%.")
+            # Prefer projects that aren't already at their concurrent upload limit.
+            free = {
+                project_id: weight for (project_id, weight) in weights.items()
+                if self.get_stats(project_id).in_flight < self.uploads_per_project
+            }
+            if len(free) > 0: weights = free
+            (project_ids, project_weights) = zip(*weights.items())
+            project_id = random.choices(project_ids, weights=project_weights)[0]
+            self.get_stats(project_id).in_flight += 1
+            return (project_id, self.get_semaphore(project_id))
+
+    def upload(self, file_name, stream, size=0):
+        """ Upload a file to the chosen project. Returns (project_id, drive_id) like `drive.upload_file`. """
+        (project_id, semaphore) = self.choose_project(size)
+        stats = self.get_stats(project_id)
+        try:
+            with semaphore:
+                start = time()
+                try:
+                    result = upload_file(file_name, stream, project_id)
+                except:
+                    with self.lock: stats.record(True)
+                    raise
+                with self.lock: stats.record(False, time() - start, size)
+                return result
+        finally:
+            with self.lock: stats.in_flight -= 1
@@ -24,4 +24,15 @@ class ConfigError(Exception):
 
 class StorageError(Exception):
     def __init__(self, msg):
-        super().__init__(msg)
\ No newline at end of file
+        super().__init__(msg)
+
+class HostUnavailableError(Exception):
+    def __init__(self, host, reason):
+        super().__init__(f"Hosting service '{host}' is unavailable: {reason}.")
+        self.host = host
+        self.reason = reason
+
+class InvalidCursorError(Exception):
+    def __init__(self, cursor):
+        super().__init__(f"Invalid pagination cursor '{cursor}'.")
+        self.cursor = cursor
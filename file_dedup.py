@@ -0,0 +1,69 @@
+import logging
+import threading
+import weakref
+from sqlalchemy import event
+from db import session_factory, File
+
+logger = logging.getLogger(__file__)
+
+# Number of locks that uploads are serialized on by hash, so identical files being uploaded at the same time are only
+# uploaded once, without keeping a lock around for every hash ever seen.
+LOCK_STRIPES = 64
+
+class FileDedup:
+    """
+    Content-addressed lookup of files that are already on Drive.
+
+    Files are keyed by the SHA-256 of their contents. Files uploaded by this process are remembered in memory, since
+    their rows may not have been committed yet, and anything else is looked up by the indexed `File.sha256` column.
+    Remembered files are forgotten when a file with the same contents is deleted, since its Drive file may be deleted
+    along with it (see Post.delete).
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.hash_locks = [threading.Lock() for i in range(LOCK_STRIPES)]
+        self.uploaded = {}
+        instances.add(self)
+
+    def get_hash_lock(self, sha256):
+        return self.hash_locks[int(sha256[:8], 16) % LOCK_STRIPES]
+
+    def lookup(self, sha256):
+        """ (drive_project_id, drive_id) of a file with the given contents, or None if there isn't one. """
+        with self.lock:
+            existing = self.uploaded.get(sha256)
+        if existing is not None:
+            return existing
+        session = session_factory()
+        try:
+            file = session.query(File).filter(
+                (File.sha256 == sha256) &
+                ((File.unknown == False) | (File.unknown == None))
+            ).first()
+            return (file.drive_project_id, file.drive_id) if file is not None else None
+        finally:
+            session.close()
+
+    def forget(self, sha256):
+        with self.lock:
+            self.uploaded.pop(sha256, None)
+
+    def upload(self, sha256, upload):
+        """ Reuse the Drive file with the same contents if one exists, otherwise call `upload`.
+            Returns ((drive_project_id, drive_id), whether an existing file was reused). """
+        with self.get_hash_lock(sha256):
+            existing = self.lookup(sha256)
+            if existing is not None:
+                return (existing, True)
+            result = upload()
+            with self.lock:
+                self.uploaded[sha256] = result
+            return (result, False)
+
+instances = weakref.WeakSet()
+
+@event.listens_for(File, "after_delete")
+def forget_deleted_file(mapper, connection, file):
+    if file.sha256 is None: return
+    for file_dedup in list(instances):
+        file_dedup.forget(file.sha256)
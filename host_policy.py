@@ -0,0 +1,229 @@
+import logging
+import threading
+import requests
+from contextlib import contextmanager
+from time import time, sleep
+from exceptions import HostUnavailableError
+
+logger = logging.getLogger(__file__)
+
+""" Default policy settings for every hosting service. Overridden by the scraper's `host_*` config options. """
+DEFAULT_SETTINGS = {
+    # Maximum concurrent requests to a host, how many more may wait for a free slot, and how long (seconds) they wait
+    # before giving up. Requests beyond those give up right away, since each waiting request holds a worker.
+    "max_in_flight": 2,
+    "max_queued": 1,
+    "queue_timeout": 60,
+    # Token bucket: sustained requests per second and the size of bursts allowed above it.
+    "rate": 2,
+    "burst": 4,
+    # Timeout (seconds) for connecting and for each read.
+    "timeout": 30,
+    # The circuit breaker opens after `failure_threshold` consecutive failures and stays open for `cooldown` seconds.
+    "failure_threshold": 5,
+    "cooldown": 300
+}
+
+# Network errors and responses that indicate the host (rather than the file) is having problems.
+FAILURE_EXCEPTIONS = (requests.exceptions.ConnectionError, requests.exceptions.Timeout, requests.exceptions.ChunkedEncodingError)
+FAILURE_STATUS_CODES = [429, 500, 502, 503, 504, 520, 521, 522, 523, 524]
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.lock = threading.Lock()
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time()
+
+    def configure(self, rate, capacity):
+        with self.lock:
+            self.rate = rate
+            self.capacity = capacity
+            self.tokens = min(self.tokens, capacity)
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            sleep(wait)
+
+class CircuitBreaker:
+    """ Closed: requests go through. Open: requests fail immediately until the cooldown is over. Half-open: one trial
+        request is let through after the cooldown, which closes the circuit if it succeeds and reopens it if it fails. """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name, failure_threshold, cooldown):
+        self.lock = threading.Lock()
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+
+    def before_request(self):
+        """ Raises HostUnavailableError if the request can't be made. Returns whether it's the half-open trial request. """
+        with self.lock:
+            if self.state == self.CLOSED:
+                return False
+            if self.state == self.OPEN and time() - self.opened_at >= self.cooldown:
+                self.state = self.HALF_OPEN
+            if self.state == self.HALF_OPEN and not self.trial_in_flight:
+                self.trial_in_flight = True
+                return True
+            raise HostUnavailableError(self.name, f"circuit breaker is open after {self.failures} consecutive failures")
+
+    def record_success(self):
+        with self.lock:
+            if self.state != self.CLOSED:
+                logger.info(f"Host '{self.name}' recovered. Closing circuit breaker.")
+            self.state = self.CLOSED
+            self.failures = 0
+            self.trial_in_flight = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial_in_flight = False
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    logger.warning(f"Host '{self.name}' failed {self.failures} consecutive times. Pausing requests to it for {self.cooldown}s.")
+                self.state = self.OPEN
+                self.opened_at = time()
+
+class RequestOutcome:
+    def __init__(self):
+        self.failed = False
+
+class HostPolicy:
+    """
+    Limits the requests made to one hosting service: at most `max_in_flight` concurrent requests, a token bucket rate
+    limit, request timeouts, and a circuit breaker. Requests that can't be made (the circuit is open, `max_queued` requests
+    are already waiting for a slot, or no slot freed up within `queue_timeout`) raise HostUnavailableError, so a slow or
+    failing host doesn't tie up workers that could be making requests to other hosts.
+    """
+    def __init__(self, name, settings):
+        self.name = name
+        self.settings = dict(settings)
+        self.semaphore = threading.BoundedSemaphore(settings["max_in_flight"])
+        self.bucket = TokenBucket(settings["rate"], settings["burst"])
+        self.breaker = CircuitBreaker(name, settings["failure_threshold"], settings["cooldown"])
+        self.in_flight = 0
+        self.queued = 0
+        self.requests = 0
+        self.failures = 0
+        self.rejected = 0
+        self.lock = threading.Lock()
+
+    @property
+    def timeout(self):
+        return self.settings["timeout"]
+
+    def configure(self, settings):
+        if settings["max_in_flight"] != self.settings["max_in_flight"]:
+            # Requests already in flight release their slot on the old semaphore.
+            self.semaphore = threading.BoundedSemaphore(settings["max_in_flight"])
+        self.bucket.configure(settings["rate"], settings["burst"])
+        self.breaker.failure_threshold = settings["failure_threshold"]
+        self.breaker.cooldown = settings["cooldown"]
+        self.settings = dict(settings)
+
+    def is_failure(self, res):
+        return res.status_code in FAILURE_STATUS_CODES
+
+    @contextmanager
+    def limit(self):
+        """ Wrap a request (including reading its body, if streamed). Set `failed` on the yielded outcome if the response
+            indicates a problem with the host. Network errors raised inside are counted as failures automatically. """
+        try:
+            trial = self.breaker.before_request()
+        except HostUnavailableError:
+            with self.lock: self.rejected += 1
+            raise
+        semaphore = self.semaphore
+        acquired = semaphore.acquire(blocking=False)
+        if not acquired:
+            with self.lock:
+                queued = self.queued < self.settings["max_queued"]
+                if queued: self.queued += 1
+            if queued:
+                try:
+                    acquired = semaphore.acquire(timeout=self.settings["queue_timeout"])
+                finally:
+                    with self.lock: self.queued -= 1
+        if not acquired:
+            # Every slot being busy is local congestion rather than a problem with the host, so it only counts as a
+            # failure if this was the breaker's trial request, which has to be resolved for another to be let through.
+            if trial:
+                self.breaker.record_failure()
+            with self.lock: self.rejected += 1
+            if queued:
+                raise HostUnavailableError(self.name, f"no request slot freed up within {self.settings['queue_timeout']}s")
+            raise HostUnavailableError(self.name, f"{self.settings['max_queued']} requests are already waiting for a request slot")
+        with self.lock:
+            self.in_flight += 1
+            self.requests += 1
+        outcome = RequestOutcome()
+        try:
+            self.bucket.acquire()
+            try:
+                yield outcome
+            except FAILURE_EXCEPTIONS:
+                outcome.failed = True
+                raise
+            finally:
+                if outcome.failed:
+                    with self.lock: self.failures += 1
+                    self.breaker.record_failure()
+                else:
+                    self.breaker.record_success()
+        finally:
+            with self.lock: self.in_flight -= 1
+            semaphore.release()
+
+    def get_state(self):
+        with self.lock:
+            return {
+                "circuit": self.breaker.state,
+                "consecutive_failures": self.breaker.failures,
+                "opened_at": self.breaker.opened_at,
+                "in_flight": self.in_flight,
+                "queued": self.queued,
+                "requests": self.requests,
+                "failures": self.failures,
+                "rejected": self.rejected,
+                "settings": dict(self.settings)
+            }
+
+policies_lock = threading.Lock()
+policies = {}
+settings = dict(DEFAULT_SETTINGS)
+
+def get_policy(name):
+    with policies_lock:
+        policy = policies.get(name)
+        if policy is None:
+            policy = policies[name] = HostPolicy(name, settings)
+        return policy
+
+def configure_policies(**new_settings):
+    """ Update the settings of every host's policy. """
+    global settings
+    with policies_lock:
+        settings = {**DEFAULT_SETTINGS, **{key: value for (key, value) in new_settings.items() if value is not None}}
+        for policy in policies.values():
+            policy.configure(settings)
+
+def get_policy_states():
+    with policies_lock:
+        return {name: policy.get_state() for (name, policy) in policies.items()}
@@ -0,0 +1,163 @@
+import logging
+
+logger = logging.getLogger(__file__)
+
+"""
+Schema migrations for existing databases.
+
+`Base.metadata.create_all` only creates missing tables, so any change to an existing table (new columns, indexes,
+backfills) has to be appended to MIGRATIONS as a function taking a connection. The number of migrations that have been
+applied is tracked with SQLite's `user_version` pragma.
+
+Fresh databases are created by `create_all` with the latest schema already in place, so migrations must be idempotent.
+"""
+
+def get_schema_version(connection):
+    return connection.execute("PRAGMA user_version").scalar()
+
+def set_schema_version(connection, version):
+    connection.execute(f"PRAGMA user_version = {int(version)}")
+
+def has_table(connection, table):
+    return connection.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (table,)).first() is not None
+
+def has_column(connection, table, column):
+    return any(row[1] == column for row in connection.execute(f"PRAGMA table_info({table})"))
+
+def add_column(connection, table, column, column_type):
+    # If the table doesn't exist yet, `create_all` will create it with the column.
+    if has_table(connection, table) and not has_column(connection, table, column):
+        connection.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+
+def create_index(connection, name, table, columns):
+    if has_table(connection, table):
+        connection.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({', '.join(columns)})")
+
+
+def add_post_last_checked_deleted(connection):
+    add_column(connection, "posts", "last_checked_deleted", "DATETIME")
+
+def add_post_fingerprint(connection):
+    add_column(connection, "posts", "fingerprint", "VARCHAR")
+
+def add_file_sha256(connection):
+    add_column(connection, "files", "sha256", "VARCHAR")
+    create_index(connection, "ix_files_sha256", "files", ["sha256"])
+
+def add_file_url_index(connection):
+    create_index(connection, "ix_files_url", "files", ["url"])
+
+def backfill_file_hosting_service(connection):
+    # Files that couldn't be downloaded used to be stored without their hosting service.
+    if not has_table(connection, "files"): return
+    from url_parser import resolve_hosting_service
+    rows = connection.execute("SELECT id, url FROM files WHERE hosting_service = '' OR hosting_service IS NULL").fetchall()
+    for (id, url) in rows:
+        hosting_service = resolve_hosting_service(url)
+        if hosting_service is not None:
+            connection.execute("UPDATE files SET hosting_service = ? WHERE id = ?", (hosting_service.name, id))
+
+def add_file_next_attempt_at(connection):
+    add_column(connection, "files", "next_attempt_at", "DATETIME")
+
+def backfill_post_prefixes(connection):
+    # Prefixes used to only be stored as a JSON list in `posts.prefixes`.
+    if not has_table(connection, "posts"): return
+    import jsonpickle
+    connection.execute("DELETE FROM post_prefixes")
+    for (post_id, prefixes) in connection.execute("SELECT id, prefixes FROM posts").fetchall():
+        prefixes = jsonpickle.decode(prefixes) if prefixes else []
+        for (position, name) in enumerate([prefix for prefix in prefixes or [] if prefix is not None]):
+            connection.execute(
+                "INSERT INTO post_prefixes (post_id, name, position) VALUES (?, ?, ?)",
+                (post_id, name, position)
+            )
+
+def create_post_search_index(connection):
+    # Full-text index of posts' titles, bodies, authors and file names, kept up to date by triggers (see db.search_posts).
+    # The search falls back to LIKE filters if SQLite wasn't built with FTS5.
+    if not has_table(connection, "posts"): return
+    from sqlalchemy.exc import OperationalError
+    try:
+        connection.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS post_search USING fts5(title, body, created_by, file_names)"
+        )
+    except OperationalError as e:
+        logger.warning(f"Couldn't create the full-text search index, searches will be slower: {e}")
+        return
+    file_names = "(SELECT group_concat(file_name, ' ') FROM files WHERE post_id = {post_id})"
+    insert_post = (
+        "INSERT INTO post_search (rowid, title, body, created_by, file_names) "
+        f"VALUES (new.id, new.title, new.body, new.created_by, {file_names.format(post_id='new.id')});"
+    )
+    update_file_names = "UPDATE post_search SET file_names = " + file_names + " WHERE rowid = {post_id};"
+    triggers = {
+        "posts_search_insert": f"AFTER INSERT ON posts BEGIN {insert_post} END",
+        "posts_search_update": (
+            "AFTER UPDATE OF id, title, body, created_by ON posts BEGIN "
+            f"DELETE FROM post_search WHERE rowid = old.id; {insert_post} END"
+        ),
+        "posts_search_delete": "AFTER DELETE ON posts BEGIN DELETE FROM post_search WHERE rowid = old.id; END",
+        "files_search_insert": f"AFTER INSERT ON files BEGIN {update_file_names.format(post_id='new.post_id')} END",
+        "files_search_update": (
+            "AFTER UPDATE OF file_name, post_id ON files BEGIN "
+            f"{update_file_names.format(post_id='old.post_id')} {update_file_names.format(post_id='new.post_id')} END"
+        ),
+        "files_search_delete": f"AFTER DELETE ON files BEGIN {update_file_names.format(post_id='old.post_id')} END"
+    }
+    for (name, trigger) in triggers.items():
+        connection.execute(f"CREATE TRIGGER IF NOT EXISTS {name} {trigger}")
+    connection.execute("DELETE FROM post_search")
+    connection.execute(
+        "INSERT INTO post_search (rowid, title, body, created_by, file_names) "
+        f"SELECT id, title, body, created_by, {file_names.format(post_id='posts.id')} FROM posts"
+    )
+
+def add_post_listing_indexes(connection):
+    for column in ["created", "view_count", "reply_count"]:
+        create_index(connection, f"ix_posts_section_{column}", "posts", ["section_id", "pinned", column, "id"])
+
+def add_query_indexes(connection):
+    create_index(connection, "ix_posts_created_by", "posts", ["created_by"])
+    create_index(connection, "ix_posts_first_scraped", "posts", ["first_scraped"])
+    create_index(connection, "ix_files_post_id", "files", ["post_id"])
+    create_index(connection, "ix_files_unknown_next_attempt_at", "files", ["unknown", "next_attempt_at"])
+    create_index(connection, "ix_files_hosting_service_first_scraped", "files", ["hosting_service", "first_scraped"])
+    # Created along with the post_prefixes table, but listed so that every index the models declare has a migration.
+    create_index(connection, "ix_post_prefixes_name_post_id", "post_prefixes", ["name", "post_id"])
+    create_index(connection, "ix_post_prefixes_post_id_position", "post_prefixes", ["post_id", "position"])
+
+MIGRATIONS = [
+    add_post_last_checked_deleted,
+    add_post_fingerprint,
+    add_file_sha256,
+    add_file_url_index,
+    backfill_file_hosting_service,
+    add_file_next_attempt_at,
+    backfill_post_prefixes,
+    create_post_search_index,
+    add_post_listing_indexes,
+    add_query_indexes
+]
+
+def get_migration_status(connection):
+    """ (version, name, whether it has been applied) of every migration. """
+    version = get_schema_version(connection)
+    return [(i + 1, migration.__name__, i < version) for (i, migration) in enumerate(MIGRATIONS)]
+
+def get_missing_indexes(connection, metadata):
+    """ Names of the indexes declared in `metadata` that don't exist in the database, i.e. that a migration is missing
+        for. """
+    existing = {row[0] for row in connection.execute("SELECT name FROM sqlite_master WHERE type='index'")}
+    return sorted([
+        index.name for table in metadata.sorted_tables for index in table.indexes
+        if index.name not in existing and has_table(connection, table.name)
+    ])
+
+def migrate(engine):
+    with engine.begin() as connection:
+        version = get_schema_version(connection)
+        for (i, migration) in enumerate(MIGRATIONS[version:], start=version):
+            logger.info(f"Applying migration {i + 1} '{migration.__name__}'.")
+            migration(connection)
+            set_schema_version(connection, i + 1)
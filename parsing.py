@@ -0,0 +1,55 @@
+import logging
+import soupsieve
+from bs4 import BeautifulSoup, FeatureNotFound
+
+logger = logging.getLogger(__file__)
+
+""" BeautifulSoup tree builders in order of preference. lxml is several times faster than the builtin html.parser,
+    which is kept as the fallback for when lxml isn't installed. """
+BACKENDS = ["lxml", "html.parser"]
+
+def is_backend_available(backend):
+    try:
+        BeautifulSoup("", backend)
+        return True
+    except FeatureNotFound:
+        return False
+
+def get_available_backends():
+    return [backend for backend in BACKENDS if is_backend_available(backend)]
+
+_backend = None
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        set_backend("auto")
+    return _backend
+
+def set_backend(backend):
+    """ Set the tree builder used by `make_soup`. "auto" uses the fastest available backend. """
+    global _backend
+    if backend == "auto":
+        backend = get_available_backends()[0]
+    elif not is_backend_available(backend):
+        fallback = get_available_backends()[0]
+        logger.warning(f"HTML parser backend '{backend}' is not available. Falling back to '{fallback}'.")
+        backend = fallback
+    if backend != _backend:
+        logger.info(f"Using HTML parser backend '{backend}'.")
+    _backend = backend
+
+def make_soup(content, backend=None):
+    return BeautifulSoup(content, backend or get_backend())
+
+class Selectors:
+    """ Pre-compiled selectors for the XenForo page structures the scraper reads. """
+    THREAD = soupsieve.compile(".structItem--thread")
+    THREAD_TITLE = soupsieve.compile(".structItem-title")
+    THREAD_MINOR = soupsieve.compile(".structItem-minor")
+    THREAD_USERNAME = soupsieve.compile(".username")
+    THREAD_START_DATE = soupsieve.compile(".structItem-startDate time")
+    THREAD_STICKY = soupsieve.compile(".structItem-status--sticky")
+    THREAD_META = soupsieve.compile(".structItem-cell--meta")
+    THREAD_STARTER_POST = soupsieve.compile(".message-threadStarterPost")
+    MESSAGE_BODY = soupsieve.compile(".message-content .bbWrapper")
@@ -0,0 +1,130 @@
+import logging
+import random
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from itertools import groupby
+from db import File, Post
+from exceptions import UnknownHostingServiceError, HostUnavailableError, FileNotFoundError
+from url_parser import resolve_hosting_service, get_hosts_signature
+
+logger = logging.getLogger(__file__)
+
+class RetryScheduler:
+    """
+    Retries files that couldn't be downloaded ("unknown" files).
+
+    Each file has a `next_attempt_at`, pushed back exponentially (`retry_backoff` minutes, doubling with every failed
+    attempt, up to `retry_backoff_max`) until it has been retried `max_retries` times. Each run retries up to
+    `retry_batch_size` due files, grouped by hosting service: every host's files are retried one after another on their own
+    worker, so a slow or failing host doesn't hold up the others.
+
+    Files whose URL doesn't belong to a supported hosting service aren't retried at all. Instead, they are matched against
+    the hosting services again whenever `Hosts` changes, which doesn't need any requests.
+    """
+    def __init__(self, scraper):
+        self.scraper = scraper
+        self.hosts_signature = None
+
+    @property
+    def config(self):
+        return self.scraper.config
+
+    def get_backoff(self, retries):
+        minutes = min(self.config["retry_backoff"] * 2 ** retries, self.config["retry_backoff_max"])
+        # Jitter so files that failed together aren't all retried together.
+        return timedelta(minutes=minutes * random.uniform(.9, 1.1))
+
+    def recheck_unrecognized_hosts(self, session):
+        """ Assign hosting services to unknown files whose URLs weren't recognized before `Hosts` changed. """
+        signature = get_hosts_signature()
+        if signature == self.hosts_signature: return
+        files = session.query(File).filter((File.unknown == True) & (File.hosting_service == "")).all()
+        recognized = 0
+        for file in files:
+            hosting_service = resolve_hosting_service(file.url)
+            if hosting_service is not None:
+                file.hosting_service = hosting_service.name
+                file.retries = 0
+                file.next_attempt_at = None
+                recognized += 1
+        session.commit()
+        logger.info(f"Rechecked {len(files)} files with unrecognized hosting services. {recognized} are now recognized.")
+        self.hosts_signature = signature
+
+    def get_due_files(self, session, now):
+        return session.query(File).filter(
+            (File.unknown == True) &
+            (File.hosting_service != "") &
+            (File.retries < self.config["max_retries"]) &
+            ((File.next_attempt_at == None) | (File.next_attempt_at <= now))
+        # SQLite sorts NULLs first, so files that have never been retried go first.
+        ).order_by(File.next_attempt_at.asc()).limit(self.config["retry_batch_size"]).all()
+
+    def retry_urls(self, urls):
+        """ Download the URLs one at a time. Returns the result of `Scraper.download_files` for each. """
+        return [self.scraper.download_files(url) for url in urls]
+
+    def apply_result(self, session, file, downloaded_files, now):
+        """ Update an unknown file from the result of downloading its URL again. """
+        file.last_updated = now
+        failed_file = next((downloaded_file for downloaded_file in downloaded_files if downloaded_file.get("unknown")), None)
+        if len(downloaded_files) == 0:
+            # The URL no longer points to any files (e.g. an emptied folder).
+            failed_file = {"exception": FileNotFoundError(file.url), "traceback": None}
+        if failed_file is not None:
+            exception = failed_file.get("exception")
+            file.exception = str(exception)
+            file.traceback = failed_file.get("traceback")
+            if isinstance(exception, UnknownHostingServiceError):
+                file.hosting_service = ""
+                return
+            # The host being unavailable (see host_policy.py) says nothing about the file, so it doesn't count as a retry.
+            if not isinstance(exception, HostUnavailableError):
+                file.retries += 1
+            file.next_attempt_at = now + self.get_backoff(file.retries)
+            return
+
+        # A URL can point to several files. The unknown file becomes the first of them and the rest are added to the post.
+        (downloaded_file, *other_files) = downloaded_files
+        file.unknown = False
+        file.exception = None
+        file.traceback = None
+        file.next_attempt_at = None
+        file.file_name = downloaded_file["file_name"]
+        file.download_url = downloaded_file["download_url"]
+        file.drive_id = downloaded_file["drive_id"]
+        file.drive_project_id = downloaded_file["drive_project_id"]
+        file.cover = downloaded_file["cover"]
+        file.file_size = downloaded_file["file_size"]
+        file.sha256 = downloaded_file["sha256"]
+        file.hosting_service = downloaded_file["hosting_service"]
+        for other_file in other_files:
+            session.add(self.scraper.create_file(file.post_id, other_file))
+        # `File.get_post` uses the scraper thread's session, so the post is loaded through this thread's own.
+        post = session.query(Post).get(file.post_id)
+        logger.info(f"Successfully retrieved file with URL '{file.url}' for post '{post.title if post else None}'.")
+
+    def run(self):
+        now = datetime.now()
+        session = self.scraper.create_db_session()
+        self.recheck_unrecognized_hosts(session)
+
+        files = self.get_due_files(session, now)
+        if len(files) == 0:
+            session.close()
+            return
+        by_host = [
+            list(host_files) for (_, host_files) in
+            groupby(sorted(files, key=lambda file: file.hosting_service), key=lambda file: file.hosting_service)
+        ]
+        logger.info(f"Retrying {len(files)} unknown files across {len(by_host)} hosting services.")
+
+        # Only URLs are handed to the workers. The session's objects are only touched on this thread.
+        with ThreadPoolExecutor(max_workers=self.config["retry_workers"], thread_name_prefix="retry_worker") as executor:
+            results = list(executor.map(self.retry_urls, [[file.url for file in host_files] for host_files in by_host]))
+
+        for (host_files, host_results) in zip(by_host, results):
+            for (file, downloaded_files) in zip(host_files, host_results):
+                self.apply_result(session, file, downloaded_files, datetime.now())
+        session.commit()
+        session.close()
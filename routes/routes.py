@@ -16,6 +16,7 @@ from dotenv import dotenv_values
 from datetime import datetime, timezone
 from dateutil.relativedelta import relativedelta
 from sqlalchemy import extract, func
+from sqlalchemy.orm import subqueryload
 from flask import Response, request, send_file, stream_with_context
 from flask_restplus import Resource, inputs, abort
 from werkzeug import datastructures
@@ -23,12 +24,15 @@ from io import BytesIO
 from fuzzywuzzy.fuzz import partial_ratio
 from urllib.parse import urlencode
 from api import app, api, cache, Flask_Session
-from db import Post, File, Prefix
+from db import (
+    Post, File, Prefix, POST_SORT_COLUMNS, serialize_posts, get_prefix_post_counts, search_posts,
+    get_post_cursor, filter_after_cursor
+)
 from url_parser import Hosts
 from commons import get_mimetype, get_env_var
 from config import load_config, save_config
 from main import Scraper
-from exceptions import AuthenticationError
+from exceptions import AuthenticationError, InvalidCursorError
 from drive import (
     get_direct_url, get_direct_url2, get_file,
     get_drive, get_drive_project_ids, load_storage_cache,
@@ -41,6 +45,8 @@ logger = logging.getLogger(__file__)
 logger.setLevel(logging.INFO)
 
 STATUS_FILE_PATH = get_env_var("STATUS_PATH")
+# Seconds that the number of posts in a section listing is cached for.
+SECTION_COUNT_TIMEOUT = 60
 
 def cache_key():
     args = request.args
@@ -51,12 +57,13 @@ def cache_key():
 
 section_entries_parser = api.parser()
 section_entries_parser.add_argument("posts", type=int, help="Posts per page", location="args", default=20)
-section_entries_parser.add_argument("sort_by", type=str, help="Sorting category", location="args", default="latest")
+section_entries_parser.add_argument("sort_by", type=str, help="Sorting category (latest, popular, active or relevance)", location="args", default="latest")
 section_entries_parser.add_argument("hide_pinned", type=inputs.boolean, help="Include/exclude pinned posts", location="args", default=True)
 section_entries_parser.add_argument("hide_deleted", type=inputs.boolean, help="Include/exclude deleted posts", location="args", default=False)
 section_entries_parser.add_argument("prefix_raw_id", type=int, action="append", help="Filter by prefix", location="args", default=None)
 section_entries_parser.add_argument("author", type=str, help="Filter by author", location="args", default=None)
 section_entries_parser.add_argument("query", type=str, help="Search query", location="args", default=None)
+section_entries_parser.add_argument("cursor", type=str, help="Return the posts after this cursor (`next_cursor` of the previous page) instead of `page`", location="args", default=None)
 @api.route("/section/<string:section_name>/<int:page>")
 class SectionEntries(Resource):
     @api.expect(section_entries_parser)
@@ -70,15 +77,26 @@ class SectionEntries(Resource):
         prefix_raw_ids = args["prefix_raw_id"]
         author = args["author"]
         query = args["query"]
+        cursor = args["cursor"]
         section_id = Scraper.SECTIONS[section_name]["id"]
 
+        if sort_by not in POST_SORT_COLUMNS and sort_by != "relevance":
+            return abort(400, f"Invalid sort_by '{sort_by}'.")
+
         session = Flask_Session()
 
+        # Blank queries don't filter anything.
+        if query is not None and query.strip() == "":
+            query = None
+        search = search_posts(session, query) if query is not None else None
+        if sort_by == "relevance" and search is None:
+            sort_by = "latest"
+
         # Page starts at 0, i.e. page=0, posts=20 will get the 0-19 most recent posts and page=1, posts=20 will get 20-39 most recent posts.
         # 1) WHERE posts.section_id=`section_id`
-        # 2) ORDER_BY posts.id DESC
+        # 2) ORDER_BY posts.created DESC, posts.id DESC
         # 3) LIMIT `per_page`
-        # 4) OFFSET `per_page * page`
+        # 4) OFFSET `per_page * page`, or with a cursor, WHERE (posts.created, posts.id) < (cursor's created, cursor's id)
         def filter_chain(filtered):
             if hide_deleted:
                 filtered = filtered.filter((Post.deleted == False) | (Post.deleted == None))
@@ -86,17 +104,14 @@ class SectionEntries(Resource):
                 for prefix_raw_id in prefix_raw_ids:
                     prefix = session.query(Prefix).filter_by(id=prefix_raw_id).first()
                     # filtered = filtered.filter(Post.prefix == prefix.name)
-                    # Post.prefixes is a JSON wrapper abstraction that is really just a Unicode string.
-                    # This makes it difficult to do performant sorting on it, when it needs to be treated as a list.
-                    filtered = filtered.filter(Post.prefixes.contains(prefix.name))
+                    filtered = filtered.filter(Post.has_prefix(prefix.name))
             if author is not None:
                 filtered = filtered.filter(Post.created_by == author)
-            if query is not None:
-                files_filtered = [
-                    file.post_id for file in session.query(File).filter(
-                        File.file_name.contains(query)
-                    )
-                ]
+            if search is not None:
+                filtered = filtered.join(search, search.c.post_id == Post.id)
+            elif query is not None:
+                # SQLite wasn't built with FTS5, so there's no full-text index.
+                files_filtered = session.query(File.post_id).filter(File.file_name.contains(query))
                 filtered = filtered.filter(
                     Post.title.contains(query) |
                     Post.created_by.contains(query) |
@@ -105,39 +120,64 @@ class SectionEntries(Resource):
                 )
             # if hide_pinned:
                 # filtered = filtered.filter(Post.pinned == False)
-            if sort_by == "latest":
-                ordered = filtered.order_by(Post.created.desc())
-            elif sort_by == "popular":
-                ordered = filtered.order_by(Post.view_count.desc())
-            elif sort_by == "active":
-                ordered = filtered.order_by(Post.reply_count.desc())
-            return ordered
-
-        non_pinned = filter_chain(session.query(Post).filter((Post.section_id == section_id) & (Post.pinned == False)))
+            return filtered
+        def order(filtered):
+            if sort_by == "relevance":
+                return filtered.order_by(search.c.rank, Post.id.desc())
+            # Ties are broken by id so that the order is stable, which keyset pagination relies on.
+            return filtered.order_by(POST_SORT_COLUMNS[sort_by].desc(), Post.id.desc())
+
+        # Every post's files are loaded by one additional query rather than one per post.
+        posts_query = session.query(Post).options(subqueryload(Post.files))
+        non_pinned = filter_chain(posts_query.filter((Post.section_id == section_id) & (Post.pinned == False)))
         # Only the first page should have pinned posts. And only when hide_pinned == False.
-        if page == 0 and not hide_pinned:
-            pinned = filter_chain(session.query(Post).filter((Post.section_id == section_id) & (Post.pinned == True)))
+        if page == 0 and cursor is None and not hide_pinned:
+            pinned = order(filter_chain(posts_query.filter((Post.section_id == section_id) & (Post.pinned == True))))
         else:
             # Create an empty query
             pinned = session.query(Post).filter(False)
 
-        num_pages = ceil(non_pinned.count() / per_page)
-        # If the page number is greater than the total number of pages, return the last page.
-        if num_pages != 0 and page > num_pages - 1:
-            # `page` goes from 0 to `num_pages - 1`
-            page = num_pages - 1
+        # Counting the posts scans every one of them, so the count is cached rather than redone on every page flip.
+        count_key = "section_count:" + section_name + "?" + urlencode([
+            (k, v) for k in ["hide_deleted", "prefix_raw_id", "author", "query"] for v in sorted(request.args.getlist(k))
+        ])
+        total = cache.get(count_key)
+        if total is None:
+            total = non_pinned.count()
+            cache.set(count_key, total, timeout=SECTION_COUNT_TIMEOUT)
+        num_pages = ceil(total / per_page)
+
+        # Results sorted by relevance have no stable key to continue from, so they're always paginated by offset.
+        if cursor is not None and sort_by != "relevance":
+            try:
+                page_posts = order(filter_after_cursor(non_pinned, sort_by, cursor)).limit(per_page).all()
+            except InvalidCursorError as e:
+                session.close()
+                return abort(400, str(e))
+        else:
+            # If the page number is greater than the total number of pages, return the last page.
+            if num_pages != 0 and page > num_pages - 1:
+                # `page` goes from 0 to `num_pages - 1`
+                page = num_pages - 1
+            page_posts = order(non_pinned).limit(per_page).offset(per_page*page).all()
 
         # Pinned posts don't count towards the pagination limit, i.e., the first page will have the pinned posts + normal pagination limit.
-        posts = pinned.all() + non_pinned.limit(per_page).offset(per_page*page).all()
+        posts = pinned.all() + page_posts
+        serialized_posts = serialize_posts(session, posts)
+        next_cursor = (
+            get_post_cursor(page_posts[-1], sort_by)
+            if sort_by != "relevance" and len(page_posts) == per_page else None
+        )
 
         session.close()
 
         return {
-            "posts": [post.serialize() for post in posts],
+            "posts": serialized_posts,
             "pages": num_pages,
-            "total": non_pinned.count(),
+            "total": total,
             "page": page,
             "per_page": per_page,
+            "next_cursor": next_cursor,
             "search_term": query
         }
 
@@ -152,8 +192,9 @@ class Prefixes(Resource):
     def get(self):
         session = Flask_Session()
         prefixes = [prefix.serialize() for prefix in session.query(Prefix)]
+        post_counts = get_prefix_post_counts(session)
         for prefix in prefixes:
-            prefix["post_count"] = session.query(Post).filter(Post.prefixes.contains(prefix["name"])).count()
+            prefix["post_count"] = post_counts.get(prefix["name"], 0)
         session.close()
         return prefixes
 
@@ -267,10 +308,13 @@ class Info(Resource):
         leakthis_username = status_data.get("leakthis_username", None)
         leakthis_password = status_data.get("leakthis_password", None)
         leakthis_user_agent = status_data.get("leakthis_user_agent", None)
+        download_cache = status_data.get("download_cache", None)
+        hosts = status_data.get("hosts", None)
 
         config = load_config()
 
-        most_recent_post = session.query(Post).order_by(Post.first_scraped.desc()).first()
+        most_recent_post = session.query(Post).options(subqueryload(Post.files)).order_by(Post.first_scraped.desc()).first()
+        most_recent_post = serialize_posts(session, [most_recent_post])[0] if most_recent_post else None
 
         num_days = 7
         num_weeks = 8
@@ -379,7 +423,10 @@ class Info(Resource):
                 "months": months
             } for (days, weeks, months) in [
                 partition_query(
-                    session.query(File).filter(File.hosting_service == hosting_service.name),
+                    session.query(File).filter(
+                        (File.hosting_service == hosting_service.name) &
+                        ((File.unknown == False) | (File.unknown == None))
+                    ),
                     time_column=File.first_scraped,
                     options={"y_label": "Hosts", "label": hosting_service.name}
                 )
@@ -461,7 +508,9 @@ class Info(Resource):
                 "pid": pid if scraper_running else None,
                 "last_scraped": last_scraped,
                 "last_error": last_error,
-                "most_recent_post": most_recent_post.serialize() if most_recent_post else None,
+                "download_cache": download_cache,
+                "hosts": hosts,
+                "most_recent_post": most_recent_post,
                 "account_info": {
                     "leakthis_username": leakthis_username,
                     "leakthis_password": leakthis_password,
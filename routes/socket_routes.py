@@ -1,7 +1,8 @@
 from flask_restplus import Resource, inputs, abort
 from flask_httpauth import HTTPTokenAuth
 from api import app, api, socket, cache, Flask_Session
-from db import Post
+from sqlalchemy.orm import subqueryload
+from db import Post, serialize_posts
 from commons import get_env_var
 
 tokens = {
@@ -21,6 +22,6 @@ class PostCreated(Resource):
     @auth.login_required
     def post(self, post_id):
         session = Flask_Session()
-        post = session.query(Post).filter_by(id=post_id).first()
-        socket.emit("post_created", post.serialize(), broadcast=True)
+        post = session.query(Post).options(subqueryload(Post.files)).filter_by(id=post_id).first()
+        socket.emit("post_created", serialize_posts(session, [post])[0], broadcast=True)
         session.close()
\ No newline at end of file
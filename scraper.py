@@ -7,19 +7,29 @@ import json
 import os
 import pickle
 import portalocker
-import math
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError, as_completed
 from dotenv import load_dotenv
 from datetime import datetime
-from bs4 import BeautifulSoup
-from tinycss2 import parse_stylesheet, parse_declaration_list
 from urllib.parse import urlparse, parse_qsl
 from PIL import Image
 from io import BytesIO
-from exceptions import AuthenticationError, MissingEnvironmentError, ConfigError, UnknownHostingServiceError
+from exceptions import AuthenticationError, MissingEnvironmentError, ConfigError
+from sqlalchemy import func
 from db import session_factory, Post, File, Prefix
-from drive import upload_file, get_direct_url, get_drive_breakdown
+from drive import get_direct_url, get_drive_breakdown
+from drive_placement import DrivePlacement
+from file_dedup import FileDedup
+from download_cache import DownloadCache
+from host_policy import configure_policies as configure_host_policies, get_policy_states as get_host_policy_states, DEFAULT_SETTINGS as DEFAULT_HOST_POLICY
 from config import load_config, load_credentials
 from url_parser import URLParser
+from async_http import AsyncSession
+from deleted_checker import DeletedPostChecker
+from retry_scheduler import RetryScheduler
+from stylesheet_cache import StylesheetCache
+from parsing import make_soup, set_backend as set_parser_backend, Selectors
 from event_api_adapter import EventAPIAdapter
 from commons import assert_is_ok, unabbr_number, get_cover, get_env_var
 
@@ -29,14 +39,61 @@ DEFAULT_CONFIG = {
     "timeout_interval": 30000,
     "update_posts": True,
     "max_retries": 3,
+    # Seconds a post's files have to download and upload before the remaining ones are recorded as unknown files.
+    "post_download_timeout": 600,
+    # Unknown files are retried after `retry_backoff` minutes, doubling after every failed retry up to `retry_backoff_max`.
+    "retry_backoff": 5,
+    "retry_backoff_max": 1440,
+    "retry_batch_size": 50,
+    "retry_workers": 4,
     "disable_db": False,
     "account_credentials": None,
     "print_posts_scraped": True,
     "log_level": "ERROR",
     "initial_pages_scraped": 2,
-    "subsequent_pages_scraped": 1
+    "subsequent_pages_scraped": 1,
+    # When enabled, sections are paged until the scraper has caught up with the archive (see `Scraper.is_caught_up`),
+    # up to `max_pages_scraped` pages, instead of a fixed `initial_pages_scraped`/`subsequent_pages_scraped`.
+    # Posts beyond the page where the scraper caught up no longer get their view/reply counts and edits updated.
+    "incremental_pagination": False,
+    "max_pages_scraped": 10,
+    "known_run_length": 5,
+    # Every post among the `check_deleted_depth` most recent is checked for deletion about once every `check_deleted_interval` minutes.
+    "check_deleted_depth": 50,
+    "check_deleted_interval": 5,
+    "check_deleted_workers": 8,
+    "check_deleted_timeout": 3,
+    # Concurrency of each stage of the post pipeline (see `Scraper.parse_posts`).
+    "post_fetch_workers": 4,
+    "download_workers": 4,
+    "upload_workers": 4,
+    # Uploads are spread across Drive projects (see drive_placement.py), with at most this many in flight per project.
+    "uploads_per_project": 2,
+    # Number of resolved hosting URLs kept in memory by the download cache (see download_cache.py).
+    "download_cache_size": 4096,
+    # Limits applied to each hosting service separately (see host_policy.py). Keep `host_max_in_flight` + `host_max_queued`
+    # below `download_workers`, so that a slow host can't hold every download worker while others are waiting.
+    "host_max_in_flight": 2,
+    "host_max_queued": 1,
+    "host_queue_timeout": 60,
+    "host_rate": 2,
+    "host_burst": 4,
+    "host_timeout": 30,
+    "host_failure_threshold": 5,
+    "host_cooldown": 300,
+    # Opt-in: use one shared aiohttp client (see async_http.py) for requests to the site instead of a requests.Session.
+    # Takes effect on login.
+    "async_http": False,
+    # Only used by the async engine.
+    "http_timeout": 30,
+    "http_connections_per_host": 8,
+    # BeautifulSoup tree builder ("lxml", "html.parser", or "auto" for the fastest one available).
+    "html_parser": "auto"
 }
 
+""" Stages of the post pipeline, each of which is backed by its own worker pool sized by `{stage}_workers`. """
+PIPELINE_STAGES = ["post_fetch", "download", "upload"]
+
 logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
 logger = logging.getLogger(__file__)
 logger.setLevel(logging.getLevelName(DEFAULT_CONFIG["log_level"]))
@@ -86,6 +143,23 @@ class Scraper:
     base_url = "https://leaked.cx"
     def __init__(self, credentials=None):
         self.token_expires = None
+        self.executors = {}
+        # native_id -> fingerprint of the listing data last written for the post (see `get_post_fingerprint`).
+        self.post_fingerprints = {}
+        self.known_prefixes = None
+        self.prefix_lock = threading.Lock()
+        self.stylesheet_cache = StylesheetCache()
+        self.drive_placement = DrivePlacement()
+        self.file_dedup = FileDedup()
+        self.download_cache = DownloadCache()
+        self.deleted_post_checker = DeletedPostChecker(self)
+        # Deletion checks run in the background so they don't hold up the scraping loop.
+        self.deleted_check_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="deleted_check")
+        self.deleted_check_future = None
+        # Unknown files are retried in the background as well.
+        self.retry_scheduler = RetryScheduler(self)
+        self.retry_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="retry")
+        self.retry_future = None
         # Load env
         self.status_file_path = get_env_var("STATUS_PATH")
         self.static_dir = get_env_var("STATIC_DIRECTORY")
@@ -129,6 +203,28 @@ class Scraper:
         # logging.root.setLevel(int_log_level)
         logger.setLevel(int_log_level)
 
+        set_parser_backend(self.config["html_parser"])
+
+        self.configure_executors()
+
+        self.drive_placement.set_uploads_per_project(self.config["uploads_per_project"])
+        self.download_cache.set_max_size(self.config["download_cache_size"])
+        configure_host_policies(**{key: self.config[f"host_{key}"] for key in DEFAULT_HOST_POLICY})
+
+    def configure_executors(self):
+        """ (Re)create the worker pool of each pipeline stage whose configured size has changed. """
+        for stage in PIPELINE_STAGES:
+            workers = self.config[f"{stage}_workers"]
+            current = self.executors.get(stage)
+            if current is not None:
+                (current_workers, current_executor) = current
+                if current_workers == workers: continue
+                # Let any work that has already been queued finish on the old pool.
+                current_executor.shutdown(wait=False)
+            self.executors[stage] = (workers, ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"{stage}_worker"))
+
+    def get_executor(self, stage):
+        return self.executors[stage][1]
             
 
     # @update_session
@@ -141,7 +237,7 @@ class Scraper:
         self.update_status(leakthis_password="*"*len(credentials["password"]))
         self.update_status(leakthis_user_agent=credentials.get("user-agent", "None"))
 
-        self.session = requests.Session()
+        self.session = self.create_http_session()
         self.session.headers.update({"User-Agent" : credentials.get("user-agent")})
         # Make sure to logout so that a new session is established
         # self.logout()
@@ -170,6 +266,19 @@ class Scraper:
         logger.info(f"Logged into Leakthis as user '{credentials['username']}'")
 
 
+    def create_http_session(self):
+        if self.config["async_http"]:
+            logger.info("Using async HTTP engine.")
+            return AsyncSession(
+                timeout=self.config["http_timeout"],
+                connections_per_host=self.config["http_connections_per_host"]
+            )
+        return requests.Session()
+
+    @property
+    def is_async_http(self):
+        return isinstance(self.session, AsyncSession)
+
     def pickle_session(self):
         with open(os.path.join(os.path.dirname(__file__), "session_cookies"), "wb+") as f:
             pickle.dump(self.session.cookies, f)
@@ -187,7 +296,9 @@ class Scraper:
     def get_csrf(self):
         res = self.session.get(self.base_url)
         assert_is_ok(res)
-        soup = BeautifulSoup(res.content, "html.parser")
+        # lxml drops the attributes of an <html> tag that isn't the first element in the document (as in saved pages),
+        # so the token is read with html.parser, which keeps them.
+        soup = make_soup(res.content, "html.parser")
         return soup.find("html")["data-csrf"]
 
     def create_db_session(self):
@@ -206,94 +317,152 @@ class Scraper:
         session.commit()
         session.close()
 
-    def retry_file(self, file):
-        downloaded_files = self.download_files(file.url)
-        """ Only retry URLs for single files. The data gets messy for URLs that point to multiple files. """
-        """ Note that download_files should never return an empty list. It should either return files or a list of one unknown file. """
-        if len(downloaded_files) == 1:
-            downloaded_file = downloaded_files[0]
-            if downloaded_file.get("unknown"):
-                # Still unknown
-                if not isinstance(downloaded_file.get("exception"), UnknownHostingServiceError):
-                    # Only increase retries if the service is unrecognized.
-                    # Other errors are indicative of an underlying issue with the associated hosting service
-                    # and may resolve with another try.
-                    file.retries += 1
-            else:
-                file.unknown = False
-                file.file_name = downloaded_file["file_name"]
-                file.download_url = downloaded_file["download_url"]
-                file.drive_id = downloaded_file["drive_id"]
-                file.drive_project_id = downloaded_file["drive_project_id"]
-                file.cover = downloaded_file["cover"]
-                file.file_size = downloaded_file["file_size"]
-                file.hosting_service = downloaded_file["hosting_service"]
-                logger.info(f"Successfully retrieved file with URL '{file.url}' for post '{file.get_post().title}'.")
-            file.last_updated = datetime.now()
-
     def retry_unknown_files(self):
-        session = self.create_db_session()
-        unknown_files = session.query(File).filter_by(unknown=True).filter(File.retries < self.config["max_retries"])
-        logger.info(f"Retrying {unknown_files.count()} unknown files.")
-        for file in unknown_files:
-            self.retry_file(file)
-        session.commit()
-        session.close()
+        self.retry_scheduler.run()
+
+    def retry_unknown_files_in_background(self):
+        # Skip if the previous run hasn't finished yet.
+        if self.retry_future is not None and not self.retry_future.done(): return
+        self.retry_future = self.retry_executor.submit(self.retry_unknown_files)
+        self.retry_future.add_done_callback(self.log_background_exception)
 
     def check_deleted_posts(self):
-        logger.info("Checking for deleted posts.")
-        num_posts = self.config["check_deleted_depth"]
-        session = self.create_db_session()
-        posts = session.query(Post).order_by(Post.created.desc())[0:num_posts]
-        for post in posts:
-            # Don't bother checking again.
-            if post.deleted: continue
-            # These requests are being made synchronously, so it would be problematic for the requests to hang.
-            # This could pretty easily be made async with aiohttp, but that should be ideally be done with a complete
-            # async rewrite of the scraper.
-            res = self.session.get(post.url, timeout=3)
-            if res.status_code == 404:
-                logger.info(f"Marking post \"{post.title}\" as deleted.")
-                post.deleted = True
-        session.commit()
-        session.close()
+        self.deleted_post_checker.run()
+
+    def check_deleted_posts_in_background(self):
+        # Skip if the previous run hasn't finished yet. The next run will pick up whatever is due.
+        if self.deleted_check_future is not None and not self.deleted_check_future.done(): return
+        self.deleted_check_future = self.deleted_check_executor.submit(self.check_deleted_posts)
+        self.deleted_check_future.add_done_callback(self.log_background_exception)
+
+    def log_background_exception(self, future):
+        if not future.cancelled() and future.exception() is not None:
+            e = future.exception()
+            logger.critical(f"Background task failed: {e}")
+            self.update_status(last_error={"error": str(e), "traceback": "".join(traceback.format_exception(type(e), e, e.__traceback__)), "time": time.time()})
 
     def download_files(self, url):
-        downloads = URLParser().download(url)
-        files = []
-        for download in downloads:
-            # Make sure the URL is associated with a supported hosting service
-            if download.get("unknown") == True:
-                files.append({
-                    "unknown": True,
-                    "url": url,
-                    "exception": download["exception"],
-                    "traceback": download["traceback"]
-                })
+        """ Download stage followed by upload stage. Each stage runs on its own worker pool,
+            so a slow hosting service doesn't hold up uploads for other files (and vice versa).
+            URLs that have already been archived are resolved from the download cache without any requests. """
+        return self.download_all_files([url], timeout=None)
+
+    def create_unknown_file(self, url, exception, traceback_str=""):
+        # Record the hosting service (if it's a supported one) even though the file couldn't be downloaded.
+        hosting_service = URLParser().get_hosting_service(url)
+        return {
+            "unknown": True,
+            "url": url,
+            "hosting_service": hosting_service.name if hosting_service is not None else "",
+            "exception": exception,
+            "traceback": traceback_str
+        }
+
+    @staticmethod
+    def close_downloads(future):
+        """ Release the spooled files of a download that finished after it was given up on. """
+        if future.cancelled() or future.exception() is not None: return
+        for download in future.result():
+            if download.get("stream") is not None:
+                download["stream"].close()
+
+    def download_all_files(self, urls, timeout=-1):
+        """ Download and upload the files behind every URL of a post concurrently, flattening URLs that point to several
+            files (e.g. GoFile folders) into the returned list in order.
+
+            Failures are isolated per URL: a URL that fails, or hasn't finished within `timeout` seconds
+            (`post_download_timeout` by default, None for no limit), becomes an unknown file that is retried later.
+            Work is submitted to the download/upload pools directly, never to the pool that is waiting on it. """
+        if timeout == -1:
+            timeout = self.config["post_download_timeout"]
+        deadline = time.time() + timeout if timeout is not None else None
+        def remaining():
+            return max(deadline - time.time(), 0) if deadline is not None else None
+
+        cached = {}
+        downloads = {}
+        for url in urls:
+            if url in cached or url in downloads: continue
+            cached_files = self.download_cache.get(url)
+            if cached_files is not None:
+                logger.info(f"Reusing {len(cached_files)} archived file(s) for '{url}'.")
+                cached[url] = cached_files
             else:
-                download_url = download["download_url"]
-                stream = download["stream"]
-                file_name = download["file_name"]
-                hosting_service = download["hosting_service"].name
-                (drive_project_id, drive_id) = upload_file(file_name, stream)
-                files.append({
-                    "url": url,
-                    "download_url": download_url,
-                    "file_name": file_name,
-                    "file_size": len(stream),
-                    "hosting_service": hosting_service,
-                    "drive_id": drive_id,
-                    "drive_project_id": drive_project_id,
-                    "cover": None
-                    # "cover": get_cover(stream)
-                })
-        return files
-
-    def download_all_files(self, urls):
-        files = []
+                downloads[url] = self.get_executor("download").submit(URLParser().download, url)
+
+        # Each URL's files are uploaded as soon as its download finishes.
+        uploads = {}
+        download_urls = {download: url for (url, download) in downloads.items()}
+        try:
+            for download in as_completed(download_urls, timeout=remaining()):
+                url = download_urls[download]
+                try:
+                    uploads[url] = [
+                        self.get_executor("upload").submit(self.upload_download, url, downloaded)
+                        for downloaded in download.result()
+                    ]
+                except Exception as e:
+                    uploads[url] = e
+        except TimeoutError:
+            for (url, download) in downloads.items():
+                if url in uploads: continue
+                download.add_done_callback(self.close_downloads)
+                uploads[url] = TimeoutError(f"Downloading '{url}' did not finish within {timeout}s.")
+
+        results = dict(cached)
+        for (url, url_uploads) in uploads.items():
+            if isinstance(url_uploads, Exception):
+                results[url] = [self.create_unknown_file(url, url_uploads)]
+                continue
+            files = []
+            for upload in url_uploads:
+                try:
+                    files.append(upload.result(timeout=remaining()))
+                except TimeoutError:
+                    e = TimeoutError(f"Uploading a file from '{url}' did not finish within {timeout}s.")
+                    files.append(self.create_unknown_file(url, e))
+                except Exception as e:
+                    logger.error(f"Failed to upload a file from '{url}': {e}")
+                    files.append(self.create_unknown_file(url, e, traceback.format_exc()))
+            self.download_cache.put(url, files)
+            results[url] = files
+
+        all_files = []
         for url in urls:
-            files.append(*self.download_files(url))
-        return files
+            all_files.extend(results[url])
+        return all_files
+
+    def upload_download(self, url, download):
+        # Make sure the URL is associated with a supported hosting service
+        if download.get("unknown") == True:
+            return self.create_unknown_file(url, download["exception"], download["traceback"])
+        download_url = download["download_url"]
+        stream = download["stream"]
+        file_name = download["file_name"]
+        hosting_service = download["hosting_service"].name
+        try:
+            # Files that have already been uploaded (e.g. reposted leaks) reuse the existing Drive file.
+            ((drive_project_id, drive_id), reused) = self.file_dedup.upload(
+                stream.sha256,
+                lambda: self.drive_placement.upload(file_name, stream, len(stream))
+            )
+            if reused:
+                logger.info(f"Reusing Drive file '{drive_id}' for '{file_name}', which has already been uploaded.")
+        finally:
+            # Release the spooled download (in memory or on disk) once it's been uploaded.
+            stream.close()
+        return {
+            "url": url,
+            "download_url": download_url,
+            "file_name": file_name,
+            "file_size": stream.size,
+            "sha256": stream.sha256,
+            "hosting_service": hosting_service,
+            "drive_id": drive_id,
+            "drive_project_id": drive_project_id,
+            "cover": None
+            # "cover": get_cover(stream)
+        }
 
     def create_file(self, post_id, file_data):
         if file_data.get("unknown") == True:
@@ -303,7 +472,7 @@ class Scraper:
                 url=file_data["url"],
                 download_url="",
                 file_size=0,
-                hosting_service="",
+                hosting_service=file_data.get("hosting_service", ""),
                 drive_id="",
                 drive_project_id="",
                 unknown=True,
@@ -320,6 +489,7 @@ class Scraper:
                 hosting_service=file_data["hosting_service"],
                 drive_id=file_data["drive_id"],
                 drive_project_id=file_data["drive_project_id"],
+                sha256=file_data["sha256"],
                 cover=file_data["cover"]
             )
         logger.info(f"Creating new file {str(file)}.")
@@ -328,10 +498,13 @@ class Scraper:
     def parse_post_content(self, post_url):
         res = self.session.get(post_url)
         assert_is_ok(res)
-        soup = BeautifulSoup(res.content, "html.parser")
+        return self.parse_post_page(res.content)
+
+    def parse_post_page(self, content):
+        soup = make_soup(content)
 
-        el = soup.select_one(".message-threadStarterPost")
-        message_content = el.select_one(".message-content").select_one(".bbWrapper")
+        el = Selectors.THREAD_STARTER_POST.select_one(soup)
+        message_content = Selectors.MESSAGE_BODY.select_one(el)
 
         text = message_content.text
 
@@ -370,79 +543,82 @@ class Scraper:
             "urls": urls
         }
 
+    def get_known_prefixes(self):
+        """ Names of every prefix that has been indexed, loaded from the DB once. """
+        if self.known_prefixes is None:
+            session = self.create_db_session()
+            self.known_prefixes = {prefix.name for prefix in session.query(Prefix.name)}
+            session.close()
+        return self.known_prefixes
+
     def parse_prefix(self, soup, prefix_tag):
         name = prefix_tag.find("span").text
 
-        session = self.create_db_session()
-        existing_prefix = session.query(Prefix).filter_by(name=name).first()
-        if existing_prefix != None:
-            return
-        logger.info(f"Parsing new prefix '{name}'")
-        url = prefix_tag["href"]
-        query_args = dict(parse_qsl(urlparse(url).query))
-        # For some reason, the ?prefix_id query param is always a list of length 1, i.e. ?prefix_id[0]={}
-        # but parse_qsl doesn't properly parse this format of list-valued params, and there are 0 alternatives.
-        # So just hard-code to read the value.
-        prefix_id = query_args.get("prefix_id[0]")
-
-        prefix_class_names = prefix_tag.find("span")["class"]
-
-        # Scrape CSS for prefix colors
-        style_urls = soup.find_all("link", rel="stylesheet")
-        style_rules = {}
-        for style_url in style_urls:
-            url = style_url["href"]
-            if urlparse(url).netloc == "":
-                url = self.base_url + url
-            res = self.session.get(url)
-            assert_is_ok(res)
-            stylesheet = parse_stylesheet(res.content.decode("utf-8"))
-            for rule in stylesheet:
-                if not hasattr(rule, "prelude"): continue
-                selector = "".join([token.serialize() for token in rule.prelude])
-                if selector == "." + ".".join(prefix_class_names):
-                    declarations = parse_declaration_list(rule.content)
-                    for declaration in declarations:
-                        style_rules[declaration.name] = "".join([token.serialize() for token in declaration.value])
-                    break
-
-        text_color = style_rules.get("color")
-        bg_color = style_rules.get("background-color") or style_rules.get("background")
+        with self.prefix_lock:
+            if name in self.get_known_prefixes():
+                return
+            logger.info(f"Parsing new prefix '{name}'")
+            url = prefix_tag["href"]
+            query_args = dict(parse_qsl(urlparse(url).query))
+            # For some reason, the ?prefix_id query param is always a list of length 1, i.e. ?prefix_id[0]={}
+            # but parse_qsl doesn't properly parse this format of list-valued params, and there are 0 alternatives.
+            # So just hard-code to read the value.
+            prefix_id = query_args.get("prefix_id[0]")
+
+            prefix_class_names = prefix_tag.find("span")["class"]
+
+            # Scrape CSS for prefix colors
+            style_urls = []
+            for style_url in soup.find_all("link", rel="stylesheet"):
+                url = style_url["href"]
+                if urlparse(url).netloc == "":
+                    url = self.base_url + url
+                style_urls.append(url)
+            style_rules = self.stylesheet_cache.get_declarations(self.session, style_urls, "." + ".".join(prefix_class_names))
+
+            text_color = style_rules.get("color")
+            bg_color = style_rules.get("background-color") or style_rules.get("background")
+
+            session = self.create_db_session()
+            prefix = Prefix(
+                prefix_id=prefix_id,
+                name=name,
+                text_color=text_color,
+                bg_color=bg_color
+            )
+            session.add(prefix)
+            session.commit()
+            session.close()
+            self.known_prefixes.add(name)
 
-        prefix = Prefix(
-            prefix_id=prefix_id,
-            name=name,
-            text_color=text_color,
-            bg_color=bg_color
-        )
-        session.add(prefix)
-        session.commit()
-        session.close()
+    def parse_prefixes(self, soup, el):
+        for prefix in Selectors.THREAD_TITLE.select_one(el).find_all("a", class_="labelLink"):
+            if prefix is not None and prefix.find("span") is not None: self.parse_prefix(soup, prefix)
 
     def parse_post_data(self, soup, el):
         native_id = int([match for match in [re.match(r"^js-threadListItem-(\d+)$", class_name) for class_name in el["class"]] if match != None][0].group(1))
         native_id = self.format_native_id(native_id)
-        title_el = el.select_one(".structItem-title")
+        title_el = Selectors.THREAD_TITLE.select_one(el)
         title = title_el.find("a", class_="")
         logger.debug(f"Parsing post '{title.text}'")
 
         prefixes = title_el.find_all("a", class_="labelLink")
-        for prefix in prefixes:
-            if prefix is not None and prefix.find("span") is not None: self.parse_prefix(soup, prefix)
 
-        minor_el = el.select_one(".structItem-minor")
-        username = minor_el.select_one(".username")
-        created_time = minor_el.select_one(".structItem-startDate").find("time")
+        minor_el = Selectors.THREAD_MINOR.select_one(el)
+        username = Selectors.THREAD_USERNAME.select_one(minor_el)
+        created_time = Selectors.THREAD_START_DATE.select_one(minor_el)
         # The created url contains just the post url, as opposed to the title, which contains /unread/.
         # The time element is a child of the created url.
         created_url = created_time.parent["href"]
         post_url = self.base_url + created_url
 
-        pinned_el = el.select_one(".structItem-status--sticky")
+        pinned_el = Selectors.THREAD_STICKY.select_one(el)
 
-        meta_el = el.select_one(".structItem-cell--meta")
-        replies = meta_el.find("dt", text="Replies").find_next_sibling("dd")
-        views = meta_el.find("dt", text="Views").find_next_sibling("dd")
+        meta_el = Selectors.THREAD_META.select_one(el)
+        # Read every <dt> label in one pass rather than searching the row once per label.
+        meta = {dt.text: dt.find_next_sibling("dd") for dt in meta_el.find_all("dt")}
+        replies = meta["Replies"]
+        views = meta["Views"]
 
         return {
             "native_id": native_id,
@@ -458,15 +634,41 @@ class Scraper:
             "view_count": unabbr_number(views.text)
         }
 
-    def parse_post(self, soup, el, section, post_callback):
-        session = self.create_db_session()
-
-        post_data = self.parse_post_data(soup, el)
+    def get_post_fingerprint(self, post_data, section):
+        """ Fingerprint of the listing data that `update_existing_posts` writes to a post. """
+        return hashlib.sha1(json.dumps([
+            post_data["title"],
+            post_data["prefixes"],
+            post_data["username"],
+            post_data["reply_count"],
+            post_data["view_count"],
+            post_data["is_pinned"],
+            self.get_section_id(section)
+        ]).encode("utf-8")).hexdigest()
+
+    def update_existing_posts(self, posts_data, section):
+        """ Listing stage of the post pipeline. Update the already indexed posts of a listing page whose listing data has changed,
+            and return the native_ids of every already indexed post on the page.
+            Posts with an unchanged fingerprint in memory are skipped without touching the DB. The rest are loaded
+            in one query, and only rows whose stored fingerprint differs are written, in a single transaction. """
+        existing_ids = set()
+        uncached = {}
+        for post_data in posts_data:
+            native_id = post_data["native_id"]
+            if self.post_fingerprints.get(native_id) == post_data["fingerprint"]:
+                existing_ids.add(native_id)
+            else:
+                uncached[native_id] = post_data
+        if len(uncached) == 0: return existing_ids
 
-        existing_post = session.query(Post).filter_by(native_id=post_data["native_id"]).first()
-        if existing_post is not None:
-            # Post already indexed
-            if not self.config["update_posts"]:
+        session = self.create_db_session()
+        for existing_post in session.query(Post).filter(Post.native_id.in_(list(uncached.keys()))):
+            post_data = uncached[existing_post.native_id]
+            existing_ids.add(existing_post.native_id)
+            if existing_post.fingerprint == post_data["fingerprint"]:
+                # Nothing has changed.
+                pass
+            elif not self.config["update_posts"]:
                 logger.debug(f"Skipping already indexed post '{existing_post.title}'.")
             else:
                 """ Update the basic post data """
@@ -485,15 +687,22 @@ class Scraper:
                 existing_post.section_id = self.get_section_id(section)
                 # The post has been updated.
                 existing_post.last_updated = datetime.now() 
+                existing_post.fingerprint = post_data["fingerprint"]
                 # Note: in the future, post_content could also be updated, e.g. useful if URLs have been updated.
-                session.commit()
-            session.close()
-            return
-        
+            self.post_fingerprints[existing_post.native_id] = existing_post.fingerprint
+        session.commit()
+        session.close()
+        return existing_ids
 
+    def fetch_post(self, post_data):
+        """ Thread page stage of the post pipeline. Runs on the post_fetch pool. """
         post_content = self.parse_post_content(post_data["post_url"])
-
         files = self.download_all_files(post_content["urls"])
+        return (post_data, post_content, files)
+
+    def create_post(self, post_data, post_content, files, section, post_callback):
+        """ Commit stage of the post pipeline. The post and its files are committed in a single transaction. """
+        session = self.create_db_session()
 
         if self.config["print_posts_scraped"] == True:
             print(post_data["title"])
@@ -508,6 +717,7 @@ class Scraper:
             reply_count=post_data["reply_count"],
             view_count=post_data["view_count"],
             pinned=post_data["is_pinned"],
+            fingerprint=post_data["fingerprint"],
 
             body=post_content["text"],
             html=post_content["cleaned_html"],
@@ -516,7 +726,8 @@ class Scraper:
             section_id=self.get_section_id(section)
         )
         session.add(post)
-        session.commit()
+        # Flush instead of committing so that the post's id is assigned without committing the post before its files.
+        session.flush()
 
         post_id = post.id
 
@@ -524,6 +735,7 @@ class Scraper:
             session.add(self.create_file(post_id, file_data))
         logger.info(f"Parsed new post {str(post)}.")
         session.commit()
+        self.post_fingerprints[post_data["native_id"]] = post_data["fingerprint"]
         if post_callback is not None: post_callback(post_id)
         session.close()
 
@@ -532,12 +744,38 @@ class Scraper:
         return post_id
 
     def parse_posts(self, content, section, post_callback=None):
-        post_ids = []
+        return [post_id for (post_data, post_id) in self.parse_listing(content, section, post_callback)]
+
+    def parse_listing(self, content, section, post_callback=None):
+        """ Returns a (post_data, post_id) pair for each thread on the listing page. post_id is None for threads that were already indexed.
+
+            Posts are scraped as a pipeline: the listing is parsed (and existing posts updated) on the calling thread, while thread pages, host downloads
+            and Drive uploads run concurrently on their own worker pools (see PIPELINE_STAGES). New posts are still committed
+            and announced in listing order. """
+        listing = []
+        pending = []
         try:
-            soup = BeautifulSoup(content, "html.parser")
-            for el in soup.select(".structItem--thread"):
-                post_id = self.parse_post(soup, el, section, post_callback)
-                post_ids.append(post_id)
+            soup = make_soup(content)
+            posts_data = []
+            for el in Selectors.THREAD.select(soup):
+                self.parse_prefixes(soup, el)
+                posts_data.append(self.parse_post_data(soup, el))
+            for post_data in posts_data:
+                post_data["fingerprint"] = self.get_post_fingerprint(post_data, section)
+            existing_ids = self.update_existing_posts(posts_data, section)
+            for post_data in posts_data:
+                if post_data["native_id"] in existing_ids:
+                    pending.append(None)
+                else:
+                    pending.append(self.get_executor("post_fetch").submit(self.fetch_post, post_data))
+
+            for (post_data, future) in zip(posts_data, pending):
+                if future is None:
+                    # Already indexed
+                    listing.append((post_data, None))
+                    continue
+                (post_data, post_content, files) = future.result()
+                listing.append((post_data, self.create_post(post_data, post_content, files, section, post_callback)))
 
         except KeyboardInterrupt: raise e
         except Exception as e:
@@ -545,17 +783,51 @@ class Scraper:
             one page failed (e.g. if it is running on the first 10 pages and the 2nd page fails it won't scrape the 3-10).
             Instead, we will skip the page for now and try again next loop.
             """
+            # Don't start work on the remainder of the page, since it won't be committed.
+            for future in pending:
+                if future is not None: future.cancel()
             traceback.print_exc()
             self.log_critical(e)
             if os.environ.get("TESTING"): raise e
-        return post_ids
+        return listing
 
     def resolve_section_url(self, section):
         return self.base_url + "/forums" + self.get_section_url(section)
 
+    def get_newest_post_time(self, section):
+        session = self.create_db_session()
+        newest = session.query(func.max(Post.created)).filter(Post.section_id == self.get_section_id(section)).scalar()
+        session.close()
+        return newest
+
+    def is_caught_up(self, listing, newest_known, known_run):
+        """ Listings are ordered by post date, so once a run of `known_run_length` already indexed threads (that are no newer than the
+            newest post that was indexed before this cycle) has been seen, everything further down has already been scraped.
+            `known_run` is the length of the run carried over from the previous page. Returns (caught_up, known_run). """
+        if newest_known is None:
+            # Nothing has been indexed yet.
+            return (False, 0)
+        for (post_data, post_id) in listing:
+            # Pinned threads are listed on the first page regardless of when they were posted.
+            if post_data["is_pinned"]: continue
+            if post_id is None and post_data["created_time"] <= newest_known:
+                known_run += 1
+                if known_run >= self.config["known_run_length"]:
+                    return (True, known_run)
+            else:
+                known_run = 0
+        return (False, known_run)
+
     # @update_session
-    def scrape_posts(self, section, pages, callback=None):
+    def scrape_posts(self, section, pages=None, callback=None):
+        """ Scrape the first `pages` pages of a section. If `pages` is None, keep paging until caught up with the archive
+            (see `is_caught_up`), up to `max_pages_scraped` pages. """
         posts = []
+        incremental = pages is None
+        if incremental:
+            pages = self.config["max_pages_scraped"]
+            newest_known = self.get_newest_post_time(section)
+            known_run = 0
         for i in range(pages):
             url = self.resolve_section_url(section)
             if i > 0:
@@ -564,14 +836,20 @@ class Scraper:
             url += "?order=post_date&direction=desc"
             res = self.session.get(url)
             assert_is_ok(res)
-            posts += self.parse_posts(res.content, section, callback)
+            listing = self.parse_listing(res.content, section, callback)
+            posts += [post_id for (post_data, post_id) in listing]
+            if incremental:
+                (caught_up, known_run) = self.is_caught_up(listing, newest_known, known_run)
+                if caught_up:
+                    logger.info(f"Caught up on section '{section}' after {i + 1} pages.")
+                    break
         return posts
     
     def resolve_static_asset_urls(self):
         """ Resolve static URLs for assets to download. """
         res = requests.get(self.base_url)
         assert_is_ok(res)
-        soup = BeautifulSoup(res.content, "html.parser")
+        soup = make_soup(res.content)
         logo_url = soup.select_one(".uix_logo > img")["src"]
         favicon_url = soup.select_one("head link[rel='icon']")["href"]
 
@@ -615,7 +893,6 @@ class Scraper:
         
 
     def scrape(self, sections, callback):
-        last_checked_deleted = datetime.now()
         # Scrape `pages` pages initially. Then only check the first page afterwards.
         if len(sections) == 0:
             raise Exception("Scraping sections cannot be empty.")
@@ -625,14 +902,11 @@ class Scraper:
         while True:
             try:
                 self.update_config()
-                for section in sections:
-                    logger.info(f"Scraping first {pages} pages for section '{section}'.")
-                    self.scrape_posts(section, pages, callback)
-                self.retry_unknown_files()
-                minutes_since_last_checked_deleted = math.floor((datetime.now() - last_checked_deleted).seconds / 60)
-                if minutes_since_last_checked_deleted >= self.config["check_deleted_interval"]:
-                    last_checked_deleted = datetime.now()
-                    self.check_deleted_posts()
+                if self.config["incremental_pagination"]:
+                    pages = None
+                self.scrape_sections(sections, pages, callback)
+                self.retry_unknown_files_in_background()
+                self.check_deleted_posts_in_background()
                 # Pages should be >1 on first loop (where you want to scrape extra to catch up with when the scraper wasn't running)
                 # Set the pages back to only 1 after first loop to avoid scraping these extra pages again, because it's extremely unlikely
                 # that enough posts to overflow the first page will be posted between scraping timeouts after catching up on the first loop.
@@ -647,11 +921,28 @@ class Scraper:
                 # Dump the traceback to a log for further reference.
                 self.log_critical(e)
 
-            self.update_status(last_scraped=time.time(), sections_scraped=sections)
+            self.update_status(last_scraped=time.time(), sections_scraped=sections, download_cache=self.download_cache.get_stats(), hosts=get_host_policy_states())
 
             logger.info("Sleeping for " + str(self.config["timeout_interval"]/1000) + "s.")
             time.sleep(self.config["timeout_interval"]/1000)
 
+    def scrape_sections(self, sections, pages, callback):
+        def scrape_section(section):
+            if pages is None:
+                logger.info(f"Scraping section '{section}' incrementally.")
+            else:
+                logger.info(f"Scraping first {pages} pages for section '{section}'.")
+            self.scrape_posts(section, pages, callback)
+        if self.is_async_http and len(sections) > 1:
+            # The shared async client can serve every section at once, so a cycle takes about as long as
+            # the slowest section rather than the sum of all of them.
+            with ThreadPoolExecutor(max_workers=len(sections), thread_name_prefix="section_worker") as executor:
+                # Consume the results so that exceptions are raised here.
+                list(executor.map(scrape_section, sections))
+        else:
+            for section in sections:
+                scrape_section(section)
+
     def scrape_hip_hop_leaks(self, *args, **kwargs):
         return self.scrape(["hip-hop-leaks"], *args, **kwargs)
 
@@ -0,0 +1,83 @@
+import hashlib
+from tempfile import SpooledTemporaryFile
+from commons import get_env_var
+from exceptions import MissingEnvironmentError
+
+# Downloads are held in memory up to DOWNLOAD_SPOOL_SIZE bytes, after which they roll over to a temporary file on disk.
+try:
+    DOWNLOAD_SPOOL_SIZE = get_env_var("DOWNLOAD_SPOOL_SIZE")
+except MissingEnvironmentError:
+    DOWNLOAD_SPOOL_SIZE = 8 * 1024 * 1024
+DOWNLOAD_SPOOL_SIZE = int(DOWNLOAD_SPOOL_SIZE)
+# Size of the chunks read from a streamed response.
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
+
+class SpooledDownload:
+    """
+    File-like buffer for a downloaded file.
+
+    Data is written in chunks as it arrives, so the size and SHA-256 digest of the file are known as soon as the
+    download finishes without reading it back. Once written, it can be handed directly to anything that reads a file
+    object (e.g. a Drive upload), and it should be closed afterwards to release the temporary file.
+    """
+    def __init__(self, max_size=DOWNLOAD_SPOOL_SIZE):
+        self.file = SpooledTemporaryFile(max_size=max_size)
+        self.hash = hashlib.sha256()
+        self.size = 0
+
+    @classmethod
+    def from_response(cls, res, chunk_size=DOWNLOAD_CHUNK_SIZE):
+        """ Spool the body of a response requested with `stream=True`. """
+        spool = cls()
+        try:
+            for chunk in res.iter_content(chunk_size=chunk_size):
+                spool.write(chunk)
+        except:
+            spool.close()
+            raise
+        finally:
+            res.close()
+        spool.seek(0)
+        return spool
+
+    @property
+    def sha256(self):
+        return self.hash.hexdigest()
+
+    def write(self, chunk):
+        self.file.write(chunk)
+        self.hash.update(chunk)
+        self.size += len(chunk)
+
+    def read(self, *args):
+        return self.file.read(*args)
+
+    def seek(self, *args):
+        return self.file.seek(*args)
+
+    def tell(self):
+        return self.file.tell()
+
+    def getvalue(self):
+        """ Read the entire file into memory. Only use this for small files. """
+        position = self.file.tell()
+        self.file.seek(0)
+        value = self.file.read()
+        self.file.seek(position)
+        return value
+
+    def close(self):
+        self.file.close()
+
+    @property
+    def closed(self):
+        return self.file.closed
+
+    def __len__(self):
+        return self.size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,86 @@
+import os
+import json
+import logging
+import threading
+import time
+import portalocker
+from tinycss2 import parse_stylesheet, parse_declaration_list
+from commons import assert_is_ok
+
+logger = logging.getLogger(__file__)
+
+STYLESHEET_CACHE_PATH = os.path.join(os.path.dirname(__file__), "stylesheet_cache.json")
+# Seconds before a cached stylesheet is revalidated against the site.
+REVALIDATE_INTERVAL = 3600
+
+def build_selector_index(css):
+    """ Map each selector in a stylesheet to its declarations (name -> serialized value).
+        Only the first rule for a selector is kept. """
+    index = {}
+    for rule in parse_stylesheet(css, skip_comments=True, skip_whitespace=True):
+        if rule.type != "qualified-rule": continue
+        selector = "".join([token.serialize() for token in rule.prelude]).strip()
+        if selector in index: continue
+        index[selector] = {
+            declaration.name: "".join([token.serialize() for token in declaration.value]).strip()
+            for declaration in parse_declaration_list(rule.content, skip_comments=True, skip_whitespace=True)
+            if declaration.type == "declaration"
+        }
+    return index
+
+class StylesheetCache:
+    """
+    Parsed stylesheets keyed by URL.
+
+    Each entry holds the stylesheet's ETag/Last-Modified validators and a selector -> declarations index that is built
+    once per version of the stylesheet, so looking up a rule is a dict lookup. Entries older than REVALIDATE_INTERVAL
+    are revalidated with a conditional request, and the cache is persisted to disk.
+    """
+    def __init__(self, path=STYLESHEET_CACHE_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = self.load()
+
+    def load(self):
+        try:
+            with portalocker.Lock(self.path, "r") as fh:
+                return json.load(fh)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def save(self):
+        with portalocker.Lock(self.path, "w+") as fh:
+            json.dump(self.entries, fh)
+
+    def get_index(self, session, url):
+        with self.lock:
+            entry = self.entries.get(url)
+            if entry is not None and time.time() - entry["validated"] < REVALIDATE_INTERVAL:
+                return entry["index"]
+
+            headers = {}
+            if entry is not None:
+                if entry.get("etag"): headers["If-None-Match"] = entry["etag"]
+                if entry.get("last_modified"): headers["If-Modified-Since"] = entry["last_modified"]
+            res = session.get(url, headers=headers)
+            if entry is not None and res.status_code == 304:
+                entry["validated"] = time.time()
+            else:
+                assert_is_ok(res)
+                logger.info(f"Indexing stylesheet '{url}'.")
+                entry = {
+                    "etag": res.headers.get("ETag"),
+                    "last_modified": res.headers.get("Last-Modified"),
+                    "validated": time.time(),
+                    "index": build_selector_index(res.content.decode("utf-8"))
+                }
+                self.entries[url] = entry
+            self.save()
+            return entry["index"]
+
+    def get_declarations(self, session, urls, selector):
+        """ Declarations for `selector` across the stylesheets at `urls`, where later stylesheets take precedence. """
+        declarations = {}
+        for url in urls:
+            declarations.update(self.get_index(session, url).get(selector, {}))
+        return declarations
@@ -3,6 +3,9 @@ import os
 import json
 from uuid import uuid4
 from io import BytesIO
+from httplib2 import Response
+from googleapiclient.errors import HttpError
+from googleapiclient.http import MediaUploadProgress
 from .mock_filesystem import file_mocker
 from .mock_env import mock_env, MOCKING
 
@@ -21,12 +24,85 @@ class DriveFile:
         self.content = self.__drive._get_file(self)
     def InsertPermission(self, *args, **kwargs):
         pass
+    def Delete(self):
+        self.__drive._delete(self)
     def __getitem__(self, key):
         return getattr(self, key)
+
+class DriveState:
+    """ State shared by every mocked Drive client during a test. """
+    def __init__(self):
+        # HTTP status codes to fail chunk uploads with, keyed by the index of the chunk in `chunks`.
+        self.chunk_failures = {}
+        # (project_id, start offset, chunk length) of every chunk that was sent.
+        self.chunks = []
+        # (project_id, id) of every deleted file.
+        self.deleted = []
+
+class UploadRequest:
+    """ Resumable upload session, following googleapiclient's `HttpRequest.next_chunk`. """
+    def __init__(self, drive, body, media_body):
+        self.drive = drive
+        self.body = body
+        self.media = media_body
+        self.resumable_uri = None
+        self.resumable_progress = 0
+        self._in_error_state = False
+        self.received = BytesIO()
+
+    def next_chunk(self, http=None, num_retries=0):
+        state = self.drive.state
+        if self.resumable_uri is None:
+            self.resumable_uri = str(uuid4())
+            self.received = BytesIO()
+        elif self._in_error_state:
+            # Resume from the last acknowledged byte.
+            self.resumable_progress = self.received.tell()
+            self._in_error_state = False
+
+        chunk = self.media.getbytes(self.resumable_progress, self.media.chunksize())
+        state.chunks.append((self.drive.project_id, self.resumable_progress, len(chunk)))
+        failure = state.chunk_failures.get(len(state.chunks) - 1)
+        if failure is not None:
+            self._in_error_state = True
+            # Failures are either a status code, or a (status code, reason) pair for errors like Drive's rate limits.
+            (status, reason) = failure if isinstance(failure, tuple) else (failure, None)
+            content = json.dumps({"error": {"code": status, "errors": [{"reason": reason}]}}).encode() if reason else b""
+            raise HttpError(Response({"status": status}), content, uri=self.resumable_uri)
+
+        self.received.write(chunk)
+        self.resumable_progress += len(chunk)
+        if self.resumable_progress < self.media.size():
+            return (MediaUploadProgress(self.resumable_progress, self.media.size()), None)
+
+        drive_file = self.drive.CreateFile({"title": self.body["title"], "content": self.received})
+        drive_file.Upload()
+        return (None, {"id": drive_file.id, "title": self.body["title"]})
+
+class FilesResource:
+    def __init__(self, drive):
+        self.drive = drive
+    def insert(self, body=None, media_body=None):
+        return UploadRequest(self.drive, body, media_body)
+
+class Service:
+    def __init__(self, drive):
+        self.drive = drive
+    def files(self):
+        return FilesResource(self.drive)
+
+class Auth:
+    def __init__(self, drive):
+        self.service = Service(drive)
+    def Get_Http_Object(self):
+        return None
+
 class Drive:
-    def __init__(self, file_mocker, project_id):
+    def __init__(self, file_mocker, project_id, state):
         self.file_mocker = file_mocker
         self.project_id = project_id
+        self.state = state
+        self.auth = Auth(self)
     
     def _get_file_path(self, drive_file):
         return os.path.join(DRIVE_DIR, self.project_id, drive_file.id)
@@ -37,6 +113,9 @@ class Drive:
         drive_file.content.seek(0)
         self.file_mocker.mock_file(file_path, drive_file.content.read())
     
+    def _delete(self, drive_file):
+        self.state.deleted.append((self.project_id, drive_file.id))
+
     def _get_file(self, drive_file):
         file_path = self._get_file_path(drive_file)
         with open(file_path, "rb") as f:
@@ -62,8 +141,8 @@ class Drive:
             "quotaBytesTotal": 16106127360
         }
 
-def get_drive(file_mocker, project_id):
-    return Drive(file_mocker, project_id)
+def get_drive(file_mocker, project_id, state):
+    return Drive(file_mocker, project_id, state)
 
 """ Mocking should always be enabled on Google Drive. """
 @pytest.fixture
@@ -84,4 +163,6 @@ def mock_drive(file_mocker, mock_env, monkeypatch):
     # file_mocker and mock_env already take $MOCKING into account. The following does not.
     # if not MOCKING: return
 
-    monkeypatch.setattr("drive.get_drive", lambda project_id: get_drive(file_mocker, project_id))
\ No newline at end of file
+    state = DriveState()
+    monkeypatch.setattr("drive.get_drive", lambda project_id: get_drive(file_mocker, project_id, state))
+    return state
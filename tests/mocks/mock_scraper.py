@@ -7,6 +7,7 @@ from .mock_env import mock_env, MOCKING
 from .mock_drive import mock_drive
 from .mock_db import mock_db
 from scraper import DEFAULT_CONFIG, Scraper
+from stylesheet_cache import STYLESHEET_CACHE_PATH
 from commons import get_env_var
 
 NETRC_PATH = os.path.join(os.path.expanduser("~"), "_netrc")
@@ -45,6 +46,7 @@ def mock_scraper(mock_requests, file_mocker, mock_scraper_env, mock_db, mock_dri
     file_mocker.mock_file(CONFIG_PATH, yaml.dump(DEFAULT_CONFIG))    
     file_mocker.mock_file(STATUS_PATH, "{}")
     file_mocker.mock_file(CREDENTIALS_PATH, yaml.dump(FAKE_CREDENTIALS))
+    file_mocker.mock_file(STYLESHEET_CACHE_PATH, "{}")
 
     file_mocker.whitelist_file(NETRC_PATH)
 
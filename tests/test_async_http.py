@@ -0,0 +1,97 @@
+import pytest
+import asyncio
+import threading
+import requests
+from aiohttp import web
+from async_http import AsyncSession
+
+async def echo(request):
+    return web.json_response({
+        "method": request.method,
+        "headers": dict(request.headers),
+        "body": (await request.read()).decode()
+    })
+
+async def set_cookie(request):
+    res = web.Response(text="ok")
+    res.set_cookie("session", "abc")
+    return res
+
+async def redirect(request):
+    res = web.HTTPFound("/echo")
+    res.set_cookie("redirected", "yes")
+    raise res
+
+async def slow(request):
+    await asyncio.sleep(2)
+    return web.Response(text="slow")
+
+async def not_found(request):
+    return web.Response(status=404, text="not found")
+
+@pytest.fixture(scope="module")
+def server():
+    """ Base URL of a local aiohttp server, running on its own event loop thread. """
+    loop = asyncio.new_event_loop()
+    app = web.Application()
+    app.router.add_route("*", "/echo", echo)
+    app.router.add_get("/set-cookie", set_cookie)
+    app.router.add_get("/redirect", redirect)
+    app.router.add_get("/slow", slow)
+    app.router.add_get("/missing", not_found)
+    runner = web.AppRunner(app)
+    loop.run_until_complete(runner.setup())
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    loop.run_until_complete(site.start())
+    port = runner.addresses[0][1]
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{port}"
+    asyncio.run_coroutine_threadsafe(runner.cleanup(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+
+@pytest.fixture
+def session():
+    session = AsyncSession(timeout=5)
+    yield session
+    session.close()
+
+def test_response(server, session):
+    session.headers = {"User-Agent": "scraper", "X-Unset": None}
+    res = session.post(server + "/echo", data=b"payload", headers={"X-Test": "1"})
+    assert res.ok and res.status_code == 200
+    assert res.url == server + "/echo"
+    assert res.headers["Content-Type"].startswith("application/json")
+    data = res.json()
+    assert data["method"] == "POST" and data["body"] == "payload"
+    # Session headers are merged with the request's, dropping unset ones like requests does.
+    assert data["headers"]["User-Agent"] == "scraper" and data["headers"]["X-Test"] == "1"
+    assert "X-Unset" not in data["headers"]
+
+    res = session.get(server + "/missing")
+    assert not res.ok and res.text == "not found"
+    with pytest.raises(requests.HTTPError):
+        res.raise_for_status()
+
+def test_cookies(server, session):
+    res = session.get(server + "/set-cookie")
+    assert res.cookies["session"] == "abc"
+    assert session.cookies["session"] == "abc"
+    assert "session=abc" in session.get(server + "/echo").json()["headers"]["Cookie"]
+
+def test_redirects(server, session):
+    res = session.get(server + "/redirect")
+    assert res.url == server + "/echo"
+    # Cookies set along the way by redirects are kept for later requests.
+    assert session.cookies["redirected"] == "yes"
+    assert "redirected=yes" in session.get(server + "/echo").json()["headers"]["Cookie"]
+    # Like requests, HEAD requests don't follow redirects unless asked to.
+    assert session.head(server + "/redirect").status_code == 302
+    assert session.head(server + "/redirect", allow_redirects=True).status_code == 200
+
+def test_timeouts(server, session):
+    with pytest.raises(requests.Timeout):
+        session.get(server + "/slow", timeout=.2)
+    # The session is still usable after a request times out.
+    assert session.get(server + "/echo", timeout=.2).status_code == 200
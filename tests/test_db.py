@@ -0,0 +1,114 @@
+import pytest
+from types import SimpleNamespace
+from datetime import datetime
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import subqueryload
+from db import (
+    Base, session_factory, Post, File, POST_SORT_COLUMNS,
+    get_post_cursor, filter_after_cursor, get_prefix_post_counts
+)
+from migrations import migrate, get_migration_status, get_missing_indexes, set_schema_version
+from retry_scheduler import RetryScheduler
+from .mocks import *
+
+def get_statements(session, run):
+    """ (statement, parameters) of every statement executed by `run`. """
+    statements = []
+    def capture(conn, cursor, statement, parameters, *args):
+        statements.append((statement, parameters))
+    event.listen(session.bind, "before_cursor_execute", capture)
+    try:
+        run()
+    finally:
+        event.remove(session.bind, "before_cursor_execute", capture)
+    return statements
+
+def get_query_plans(session, run):
+    """ EXPLAIN QUERY PLAN of every statement executed by `run`. """
+    statements = get_statements(session, run)
+    connection = session.bind.raw_connection()
+    try:
+        cursor = connection.cursor()
+        return [
+            " ".join([row[-1] for row in cursor.execute("EXPLAIN QUERY PLAN " + statement, parameters).fetchall()])
+            for (statement, parameters) in statements
+        ]
+    finally:
+        connection.close()
+
+def get_query_plan(session, run):
+    (plan,) = get_query_plans(session, run)
+    return plan
+
+@pytest.fixture
+def session(mock_db):
+    session = session_factory()
+    yield session
+    session.close()
+
+def test_section_listing_uses_indexes(session):
+    post = Post(id=1, created=datetime.now(), view_count=0, reply_count=0)
+    listing = session.query(Post).filter((Post.section_id == 1) & (Post.pinned == False))
+    for (sort_by, column) in POST_SORT_COLUMNS.items():
+        for query in [listing, filter_after_cursor(listing, sort_by, get_post_cursor(post, sort_by))]:
+            plan = get_query_plan(session, lambda: query.order_by(column.desc(), Post.id.desc()).limit(20).all())
+            assert f"ix_posts_section_{column.key}" in plan
+            # Rows come out of the index already sorted.
+            assert "TEMP B-TREE" not in plan
+
+def test_post_queries_use_indexes(session):
+    posts = session.query(Post)
+    assert "ix_post_prefixes_name_post_id" in get_query_plan(session, lambda: posts.filter(Post.has_prefix("LEAK")).all())
+    assert "ix_posts_created_by" in get_query_plan(session, lambda: posts.filter(Post.created_by == "author").all())
+    assert "ix_posts_first_scraped" in get_query_plan(session, lambda: posts.order_by(Post.first_scraped.desc()).first())
+    assert "ix_post_prefixes_name_post_id" in get_query_plan(session, lambda: get_prefix_post_counts(session))
+    # Loading the files of a page of posts.
+    session.add(Post(
+        native_id="indexed", section_id=1, title="", url="", prefixes=[], created_by="", created=datetime.now(),
+        reply_count=0, view_count=0, body="", html="", pinned=False
+    ))
+    session.commit()
+    (_, files_plan) = get_query_plans(session, lambda: posts.options(subqueryload(Post.files)).filter_by(native_id="indexed").all())
+    assert "ix_files_post_id" in files_plan
+
+def test_unchanged_prefixes_are_not_rewritten(session):
+    session.add(Post(
+        native_id="unchanged_prefixes", section_id=1, title="", url="", prefixes=["LEAK", "SNIPPET"], created_by="",
+        created=datetime.now(), reply_count=0, view_count=0, body="", html="", pinned=False
+    ))
+    session.commit()
+    post = session.query(Post).filter_by(native_id="unchanged_prefixes").one()
+    def update(prefixes):
+        post.prefixes = prefixes
+        post.view_count += 1
+        session.commit()
+    # Updating a post with the prefixes it already has only updates the post itself.
+    statements = get_statements(session, lambda: update(["LEAK", "SNIPPET"]))
+    assert len(statements) == 1 and statements[0][0].startswith("UPDATE posts")
+
+    statements = get_statements(session, lambda: update(["LEAK"]))
+    assert any(["post_prefixes" in statement for (statement, _) in statements])
+    session.refresh(post)
+    assert list(post.prefix_names) == ["LEAK"]
+
+def test_file_queries_use_indexes(session):
+    files = session.query(File)
+    assert "ix_files_url" in get_query_plan(session, lambda: files.filter_by(url="https://anonfiles.com/a").all())
+    assert "ix_files_sha256" in get_query_plan(session, lambda: files.filter_by(sha256="0" * 64).first())
+    assert "ix_files_hosting_service_first_scraped" in get_query_plan(session, lambda: files.filter_by(hosting_service="AnonFiles").count())
+    scheduler = RetryScheduler(SimpleNamespace(config={"max_retries": 3, "retry_batch_size": 50}))
+    assert "ix_files_unknown_next_attempt_at" in get_query_plan(session, lambda: scheduler.get_due_files(session, datetime.now()))
+
+def test_migrations_create_declared_indexes():
+    # A database from before any migration: the tables exist, but without any of the indexes added since.
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        for (name,) in connection.execute("SELECT name FROM sqlite_master WHERE type='index' AND sql IS NOT NULL").fetchall():
+            connection.execute(f"DROP INDEX {name}")
+        set_schema_version(connection, 0)
+        assert len(get_missing_indexes(connection, Base.metadata)) > 0
+    migrate(engine)
+    with engine.connect() as connection:
+        assert get_missing_indexes(connection, Base.metadata) == []
+        assert all([applied for (_, _, applied) in get_migration_status(connection)])
@@ -0,0 +1,153 @@
+import pytest
+import json
+import drive
+from drive_placement import DrivePlacement
+from io import BytesIO
+from googleapiclient.errors import HttpError
+from exceptions import AuthenticationError
+from .mocks import *
+from .mocks.mock_drive import mock_drive
+
+CHUNK_SIZE = 256 * 1024
+
+@pytest.fixture
+def chunked_drive(mock_drive, monkeypatch):
+    monkeypatch.setattr("drive.DRIVE_UPLOAD_CHUNK_SIZE", CHUNK_SIZE)
+    monkeypatch.setattr("drive.sleep", lambda seconds: None)
+    drive.update_storage_cache(drive.load_storage_cache())
+    return mock_drive
+
+def read_mock_file(file):
+    data = file["file_data"].read()
+    file["file_data"].seek(0)
+    return data
+
+def get_uploaded_content(project_id, id):
+    file = drive.get_file(project_id, id)
+    file.FetchContent()
+    return file.content.read()
+
+def test_chunked_upload(chunked_drive):
+    file = mock_files[1]
+    data = read_mock_file(file)
+    (project_id, id) = drive.upload_file(file["file_name"], BytesIO(data))
+    assert get_uploaded_content(project_id, id) == data
+    assert [start for (_, start, _) in chunked_drive.chunks] == list(range(0, len(data), CHUNK_SIZE))
+
+def test_upload_resumes_from_acknowledged_offset(chunked_drive):
+    file = mock_files[0]
+    data = read_mock_file(file)
+    chunked_drive.chunk_failures = {2: 503, 5: (403, "userRateLimitExceeded")}
+    (project_id, id) = drive.upload_file(file["file_name"], BytesIO(data))
+    assert get_uploaded_content(project_id, id) == data
+    # Failed chunks are resent from where they started rather than from the beginning of the file.
+    starts = [start for (_, start, _) in chunked_drive.chunks]
+    assert starts[:7] == [0, CHUNK_SIZE, CHUNK_SIZE * 2, CHUNK_SIZE * 2, CHUNK_SIZE * 3, CHUNK_SIZE * 4, CHUNK_SIZE * 4]
+
+def test_upload_gives_up(chunked_drive):
+    file = mock_files[1]
+    data = read_mock_file(file)
+    chunked_drive.chunk_failures = {i: 503 for i in range(drive.DRIVE_UPLOAD_RETRIES + 1)}
+    with pytest.raises(HttpError):
+        drive.upload_file(file["file_name"], BytesIO(data))
+    assert len(chunked_drive.chunks) == drive.DRIVE_UPLOAD_RETRIES + 1
+
+    # Errors that won't go away by retrying aren't retried.
+    chunked_drive.chunks.clear()
+    chunked_drive.chunk_failures = {0: 403}
+    with pytest.raises(HttpError):
+        drive.upload_file(file["file_name"], BytesIO(data))
+    assert len(chunked_drive.chunks) == 1
+    chunked_drive.chunks.clear()
+    chunked_drive.chunk_failures = {0: (403, "insufficientFilePermissions")}
+    with pytest.raises(HttpError):
+        drive.upload_file(file["file_name"], BytesIO(data))
+    assert len(chunked_drive.chunks) == 1
+
+def test_upload_accounts_quota_locally(chunked_drive, monkeypatch):
+    reconciled = []
+    get_storage_quota = drive.get_storage_quota
+    def count_reconciliation(project_id=None):
+        reconciled.append(project_id)
+        return get_storage_quota(project_id)
+    monkeypatch.setattr("drive.get_storage_quota", count_reconciliation)
+
+    data = read_mock_file(mock_files[1])
+    quota_used = drive.load_storage_cache()[drive.get_active_project_id()]["quota_used"]
+    (project_id, id) = drive.upload_file("file1", BytesIO(data))
+    assert reconciled == []
+    assert drive.load_storage_cache()[project_id]["quota_used"] == quota_used + len(data)
+
+    # Once the cached usage is stale, the next upload reconciles it with Drive.
+    cache = drive.load_storage_cache()
+    cache[project_id]["last_reconciled"] = 0
+    drive.save_storage_cache(cache)
+    drive.upload_file("file2", BytesIO(data))
+    assert reconciled == [project_id]
+    assert drive.load_storage_cache()[project_id]["quota_used"] == drive.get_drive(project_id).GetAbout()["quotaBytesUsed"]
+
+def test_placement_weights():
+    placement = DrivePlacement()
+    storage_cache = {
+        "empty": { "quota_used": 0, "quota_total": 1000 },
+        "half": { "quota_used": 500, "quota_total": 1000 },
+        "full": { "quota_used": 1000, "quota_total": 1000 }
+    }
+    weights = placement.get_weights(storage_cache, storage_cache.keys())
+    assert "full" not in weights
+    assert weights["empty"] > weights["half"]
+
+    # Failing projects are weighted down.
+    for i in range(5):
+        placement.get_stats("empty").record(True)
+    weights = placement.get_weights(storage_cache, storage_cache.keys())
+    assert weights["empty"] < weights["half"]
+
+def test_placement_upload(chunked_drive):
+    placement = DrivePlacement()
+    data = read_mock_file(mock_files[1])
+    (project_id, id) = placement.upload("file", BytesIO(data), len(data))
+    assert project_id in drive.get_drive_project_ids()
+    assert get_uploaded_content(project_id, id) == data
+    stats = placement.get_stats(project_id)
+    assert stats.in_flight == 0 and stats.error_rate == 0 and stats.seconds_per_mib is not None
+
+def test_drive_registry(tmp_path, monkeypatch):
+    authorized = []
+    class MockGoogleAuth:
+        access_token_expired = False
+        def Authorize(self):
+            authorized.append(self.credentials)
+    class MockGoogleDrive:
+        def __init__(self, auth):
+            self.auth = auth
+    monkeypatch.setattr("drive.GoogleAuth", MockGoogleAuth)
+    monkeypatch.setattr("drive.GoogleDrive", MockGoogleDrive)
+    monkeypatch.setattr("drive.ServiceAccountCredentials.from_json_keyfile_name", lambda path, scopes: path)
+    monkeypatch.setattr("drive.drive_registry", {"credentials_file": None, "credential_paths": {}, "clients": {}})
+
+    def write_key_files(name, project_ids):
+        paths = []
+        for project_id in project_ids:
+            path = tmp_path / f"{name}_{project_id}.json"
+            path.write_text(json.dumps({"project_id": project_id}))
+            paths.append(str(path))
+        monkeypatch.setenv("DRIVE_CREDENTIALS_FILE", ",".join(paths))
+        return paths
+
+    (path_a, path_b) = write_key_files("old", ["a", "b"])
+    client_a = drive.get_drive("a")
+    # Clients are created once per project and reused afterwards.
+    assert drive.get_drive("a") is client_a
+    client_b = drive.get_drive("b")
+    assert client_b is not client_a and drive.get_drive("b") is client_b
+    assert authorized == [path_a, path_b]
+
+    # Changing the key files discards every cached client.
+    (new_path_a,) = write_key_files("new", ["a"])
+    new_client_a = drive.get_drive("a")
+    assert new_client_a is not client_a and new_client_a.auth.credentials == new_path_a
+    assert drive.get_drive("a") is new_client_a
+    assert authorized == [path_a, path_b, new_path_a]
+    with pytest.raises(AuthenticationError):
+        drive.get_drive("b")
@@ -1,11 +1,32 @@
+import pytest
 import requests
+from requests import Session
+from requests.exceptions import ConnectTimeout
+import db
 import os
+import math
 import sys
+import time
+import concurrent.futures
+from datetime import datetime, timedelta
 from bs4 import BeautifulSoup
-from db import session_factory, Post, Prefix, File
+from sqlalchemy import event
+from sqlalchemy.orm import subqueryload
+from db import (
+    session_factory, serialize_posts, get_prefix_post_counts, search_posts, get_post_cursor, filter_after_cursor,
+    Post, PostPrefix, Prefix, File, POST_SORT_COLUMNS
+)
+from migrations import backfill_post_prefixes
 from main import Scraper
 from drive import get_file
+from spool import SpooledDownload
+from url_parser import URLParser, AnonFiles
+from download_cache import DownloadCache
+from deleted_checker import DeletedPostChecker
+from stylesheet_cache import StylesheetCache, build_selector_index
+from exceptions import InvalidCursorError, HostUnavailableError
 from .mocks import *
+from .mocks.mock_drive import mock_drive
 
 def test_scrape_static_assets(mock_scraper):
     mock_scraper.scrape_static_assets()
@@ -57,5 +78,435 @@ def test_parse_section(mock_scraper):
 
     session.close()
 
-def test_parse_prefix(mock_scraper):
-    pass
\ No newline at end of file
+def test_rescrape_unchanged_section(mock_scraper):
+    section_name = "hip-hop-leaks"
+    mock_scraper.scrape_posts(section_name, pages=1)
+    session = session_factory()
+    last_updated = {post.id: post.last_updated for post in session.query(Post)}
+    session.close()
+
+    # Every post on the page is already indexed and unchanged, so nothing should be created or rewritten.
+    posts = mock_scraper.scrape_posts(section_name, pages=1)
+    assert len(posts) > 0
+    assert all(post_id is None for post_id in posts)
+    session = session_factory()
+    assert {post.id: post.last_updated for post in session.query(Post)} == last_updated
+    session.close()
+
+def test_incremental_scrape_stops_when_caught_up(mock_scraper):
+    section_name = "hip-hop-leaks"
+    mock_scraper.scrape_posts(section_name, pages=1)
+    # Only the first page of the section is mocked, so this would fail if it kept paging.
+    posts = mock_scraper.scrape_posts(section_name)
+    assert len(posts) > 0
+    assert all(post_id is None for post_id in posts)
+
+def test_duplicate_files_share_drive_file(mock_scraper, mock_drive):
+    file_data = mock_files[1]["file_data"].read()
+    mock_files[1]["file_data"].seek(0)
+    def create_download(file_name):
+        stream = SpooledDownload()
+        stream.write(file_data)
+        stream.seek(0)
+        return {
+            "file_name": file_name,
+            "download_url": "https://cdn.anonfiles.com/" + file_name,
+            "hosting_service": AnonFiles(),
+            "stream": stream
+        }
+    first = mock_scraper.upload_download("https://anonfiles.com/a", create_download("a.mp3"))
+    chunks_sent = len(mock_drive.chunks)
+    second = mock_scraper.upload_download("https://anonfiles.com/b", create_download("b.mp3"))
+    assert len(mock_drive.chunks) == chunks_sent
+    assert first["sha256"] == second["sha256"]
+    assert (second["drive_project_id"], second["drive_id"]) == (first["drive_project_id"], first["drive_id"])
+
+    # Both files belong to one post. Deleting it deletes their Drive file once, and the contents are forgotten.
+    session = db.persistent_session
+    post = Post(
+        native_id="deduplicated", section_id=-1, title="", url="", prefixes=[], created_by="", created=datetime.now(),
+        reply_count=0, view_count=0, body="", html="", pinned=False
+    )
+    session.add(post)
+    session.commit()
+    session.add_all([mock_scraper.create_file(post.id, first), mock_scraper.create_file(post.id, second)])
+    session.commit()
+    post.delete()
+    assert mock_drive.deleted == [(first["drive_project_id"], first["drive_id"])]
+    third = mock_scraper.upload_download("https://anonfiles.com/c", create_download("c.mp3"))
+    assert len(mock_drive.chunks) > chunks_sent
+    assert third["drive_id"] != first["drive_id"]
+
+def test_download_cache(mock_scraper):
+    url = "https://anonfiles.com/reposted"
+    cache = DownloadCache()
+    assert cache.get(url) is None
+
+    session = session_factory()
+    file = File(post_id=-1, url=url, download_url="", file_name="reposted.mp3", file_size=1, hosting_service="AnonFiles", drive_id="reposted", drive_project_id="mocked_drive_project")
+    session.add(file)
+    session.commit()
+    assert [f["drive_id"] for f in cache.get(url)] == ["reposted"]
+    assert cache.get_stats()["hits"] == 1 and cache.get_stats()["misses"] == 1
+
+    # Subsequent lookups are served from memory, until the file is deleted.
+    assert [f["drive_id"] for f in cache.get(url)] == ["reposted"]
+    assert cache.get_stats()["hits"] == 2
+    session.delete(file)
+    session.commit()
+    session.close()
+    assert cache.get(url) is None
+
+def test_retry_scheduler(mock_scraper, mock_requests, monkeypatch):
+    url = "https://anonfiles.com/retried/file_mp3"
+    mock_requests.get(url, status_code=404)
+    session = session_factory()
+    file = File(post_id=-1, url=url, download_url="", file_name="", file_size=0, hosting_service="", drive_id="", drive_project_id="", unknown=True)
+    session.add(file)
+    session.commit()
+    def retry_count():
+        return len([request for request in mock_requests.request_history if request.url == url])
+
+    # Files that were stored without a hosting service are matched against the current hosting services, then retried.
+    mock_scraper.retry_unknown_files()
+    session.refresh(file)
+    assert file.hosting_service == "AnonFiles"
+    assert file.unknown and file.retries == 1
+    assert file.next_attempt_at > datetime.now()
+    assert retry_count() == 1
+
+    # The file isn't due again until its backoff has passed.
+    mock_scraper.retry_unknown_files()
+    assert retry_count() == 1
+
+    # When only some of a URL's files fail, the failure recorded is that of the first failed file.
+    downloaded = {"unknown": False, "exception": None, "traceback": None}
+    failed = {"unknown": True, "exception": HostUnavailableError("AnonFiles", "circuit open"), "traceback": "traceback"}
+    mock_scraper.retry_scheduler.apply_result(session, file, [downloaded, failed], datetime.now())
+    assert file.exception == str(failed["exception"]) and file.traceback == "traceback"
+    # The host being unavailable doesn't count as a retry.
+    assert file.unknown and file.retries == 1
+
+    # Results are applied on the retry thread, so only its own session is used (not the scraper thread's `persistent_session`).
+    def downloaded_file(file_name):
+        return {
+            "url": url, "file_name": file_name, "download_url": "", "file_size": 0, "hosting_service": "AnonFiles",
+            "drive_id": "", "drive_project_id": "", "sha256": None, "cover": None
+        }
+    with monkeypatch.context() as m:
+        m.setattr(db, "persistent_session", None)
+        mock_scraper.retry_scheduler.apply_result(session, file, [downloaded_file("a.mp3"), downloaded_file("b.mp3")], datetime.now())
+    assert not file.unknown and file.file_name == "a.mp3"
+    session.rollback()
+
+    session.delete(file)
+    session.commit()
+    session.close()
+
+def test_retry_empty_result(mock_scraper, monkeypatch):
+    url = "https://anonfiles.com/emptied/folder"
+    session = session_factory()
+    file = File(post_id=-1, url=url, download_url="", file_name="", file_size=0, hosting_service="AnonFiles", drive_id="", drive_project_id="", unknown=True)
+    session.add(file)
+    session.commit()
+
+    # A URL that now points to no files (e.g. an emptied folder) counts as a failed attempt.
+    monkeypatch.setattr(mock_scraper, "download_files", lambda url: [])
+    mock_scraper.retry_unknown_files()
+    session.refresh(file)
+    assert file.unknown and file.retries == 1
+    assert file.next_attempt_at > datetime.now()
+    assert url in file.exception
+
+    session.delete(file)
+    session.commit()
+    session.close()
+
+def test_download_all_files(mock_scraper, monkeypatch):
+    def download(self, url):
+        if url.endswith("slow"):
+            time.sleep(1)
+        unknown = {"unknown": True, "exception": Exception(url), "traceback": ""}
+        # The folder URL points to two files.
+        return [unknown, unknown] if url.endswith("folder") else [unknown]
+    monkeypatch.setattr(URLParser, "download", download)
+    urls = ["https://anonfiles.com/folder", "https://anonfiles.com/slow", "https://anonfiles.com/other"]
+    files = mock_scraper.download_all_files(urls, timeout=.5)
+    # Files are flattened in the order of their URLs.
+    assert [file["url"] for file in files] == [urls[0], urls[0], urls[1], urls[2]]
+    assert all([file["unknown"] for file in files])
+    # The slow URL is given up on without holding up the others.
+    assert isinstance(files[2]["exception"], concurrent.futures.TimeoutError)
+    assert str(files[3]["exception"]) == urls[2]
+
+    # A URL that can't be parsed is recorded as an unknown file too.
+    [file] = mock_scraper.download_all_files([None], timeout=.5)
+    assert file["unknown"] and file["hosting_service"] == ""
+
+def test_serialize_posts(mock_scraper):
+    session = session_factory()
+    session.add(Prefix(prefix_id=-1, name="SERIALIZED", text_color="white", bg_color="red"))
+    posts = [
+        Post(
+            native_id=f"serialized.{i}", section_id=-1, title=f"Serialized {i}", url="", prefixes=["SERIALIZED"],
+            created_by="", created=datetime.now(), reply_count=0, view_count=0, body="", html="", pinned=False
+        ) for i in range(3)
+    ]
+    session.add_all(posts)
+    session.commit()
+    for post in posts:
+        session.add(File(post_id=post.id, url="https://anonfiles.com/serialized", download_url="", file_name="a.m4a", file_size=1, hosting_service="AnonFiles", drive_id="", drive_project_id=""))
+    session.commit()
+    post_ids = [post.id for post in posts]
+    session.close()
+
+    statements = []
+    def count_statement(conn, cursor, statement, *args):
+        statements.append(statement)
+    session = session_factory()
+    event.listen(session.bind, "before_cursor_execute", count_statement)
+    try:
+        loaded = session.query(Post).options(subqueryload(Post.files)).filter(Post.id.in_(post_ids)).all()
+        serialized = serialize_posts(session, loaded)
+    finally:
+        event.remove(session.bind, "before_cursor_execute", count_statement)
+    # Posts, their files, and their prefixes, regardless of the number of posts.
+    assert len(statements) == 3
+    assert all([[prefix["name"] for prefix in post["prefixes"]] == ["SERIALIZED"] for post in serialized])
+    assert all([[file["hosting_service"]["name"] for file in post["files"]] == ["AnonFiles"] for post in serialized])
+
+    for post in loaded:
+        for file in post.files:
+            session.delete(file)
+        session.delete(post)
+    session.query(Prefix).filter_by(name="SERIALIZED").delete()
+    session.commit()
+    session.close()
+
+def test_post_prefixes(mock_scraper):
+    session = session_factory()
+    def create_post(native_id, prefixes):
+        return Post(
+            native_id=native_id, section_id=-1, title=native_id, url="", prefixes=prefixes,
+            created_by="", created=datetime.now(), reply_count=0, view_count=0, body="", html="", pinned=False
+        )
+    posts = [create_post("prefixed.0", ["PREFIXED", "PREFIXED HQ"]), create_post("prefixed.1", ["SNIPPET PREFIXED"])]
+    session.add_all(posts)
+    session.commit()
+    assert [(entry.name, entry.position) for entry in posts[0].prefix_entries] == [("PREFIXED", 0), ("PREFIXED HQ", 1)]
+
+    # Prefixes are matched exactly rather than as substrings of the JSON column.
+    def prefixed(name):
+        return [post.native_id for post in session.query(Post).filter(Post.section_id == -1).filter(Post.has_prefix(name))]
+    assert prefixed("PREFIXED") == ["prefixed.0"]
+    assert get_prefix_post_counts(session)["PREFIXED"] == 1
+
+    # Changing the prefixes replaces the rows.
+    posts[1].prefixes = ["PREFIXED"]
+    session.commit()
+    assert sorted(prefixed("PREFIXED")) == ["prefixed.0", "prefixed.1"]
+    assert prefixed("SNIPPET PREFIXED") == []
+
+    # Existing posts are backfilled from the JSON column.
+    session.query(PostPrefix).delete()
+    session.commit()
+    with session.bind.begin() as connection:
+        backfill_post_prefixes(connection)
+    assert sorted(prefixed("PREFIXED")) == ["prefixed.0", "prefixed.1"]
+    assert prefixed("PREFIXED HQ") == ["prefixed.0"]
+
+    for post in posts:
+        session.delete(post)
+    session.commit()
+    assert session.query(PostPrefix).filter(PostPrefix.post_id.in_([post.id for post in posts])).count() == 0
+    session.close()
+
+def test_search_posts(mock_scraper):
+    session = session_factory()
+    def create_post(native_id, title, body):
+        return Post(
+            native_id=native_id, section_id=-1, title=title, url="", prefixes=[],
+            created_by="searcher", created=datetime.now(), reply_count=0, view_count=0, body=body, html="", pinned=False
+        )
+    posts = [
+        create_post("searched.0", "Unrelated", "Mentions zanzibar once"),
+        create_post("searched.1", "Zanzibar Sessions", "Zanzibar zanzibar"),
+        create_post("searched.2", "Unrelated", "Nothing")
+    ]
+    session.add_all(posts)
+    session.commit()
+    session.add(File(post_id=posts[2].id, url="", download_url="", file_name="zanzibar_demo.mp3", file_size=1, hosting_service="", drive_id="", drive_project_id=""))
+    session.commit()
+    def search(query):
+        results = search_posts(session, query)
+        return [
+            post.native_id for post in
+            session.query(Post).join(results, results.c.post_id == Post.id).order_by(results.c.rank, Post.id)
+        ]
+
+    # Title matches rank highest and body matches lowest. The last word is matched as a prefix.
+    assert search("zanzib") == ["searched.1", "searched.2", "searched.0"]
+    assert search("zanzibar sess") == ["searched.1"]
+    # Words are never parsed as FTS5 syntax.
+    assert search('zanzibar" OR "nothing') == []
+
+    # The index is kept up to date as posts are updated and deleted.
+    posts[2].title = "Kilimanjaro"
+    session.delete(posts[0])
+    session.commit()
+    assert search("zanzibar") == ["searched.1", "searched.2"]
+    assert search("kilimanjaro") == ["searched.2"]
+
+    session.query(File).filter_by(post_id=posts[2].id).delete()
+    session.delete(posts[1])
+    session.delete(posts[2])
+    session.commit()
+    assert search("zanzibar") == []
+    session.close()
+
+def test_cursor_pagination(mock_scraper):
+    session = session_factory()
+    created = [datetime(2021, 1, 1), datetime(2021, 1, 2)]
+    # Posts share sort values so that ties have to be broken by id.
+    posts = [
+        Post(
+            native_id=f"paginated.{i}", section_id=-2, title="", url="", prefixes=[], created_by="",
+            created=created[i % 2], reply_count=0, view_count=i // 3, body="", html="", pinned=False
+        ) for i in range(7)
+    ]
+    session.add_all(posts)
+    session.commit()
+    section = session.query(Post).filter(Post.section_id == -2)
+    for (sort_by, column) in POST_SORT_COLUMNS.items():
+        ordered = [post.id for post in section.order_by(column.desc(), Post.id.desc())]
+        paginated = []
+        cursor = None
+        while True:
+            page = section if cursor is None else filter_after_cursor(section, sort_by, cursor)
+            page = page.order_by(column.desc(), Post.id.desc()).limit(3).all()
+            paginated += [post.id for post in page]
+            if len(page) < 3: break
+            cursor = get_post_cursor(page[-1], sort_by)
+        assert paginated == ordered
+
+    with pytest.raises(InvalidCursorError):
+        filter_after_cursor(section, "latest", "invalid")
+    # Cursors only work with the sort order they were created for.
+    with pytest.raises(InvalidCursorError):
+        filter_after_cursor(section, "popular", get_post_cursor(posts[0], "latest"))
+
+    for post in posts:
+        session.delete(post)
+    session.commit()
+    session.close()
+
+def test_deleted_post_checker(mock_scraper, mock_requests, monkeypatch):
+    base = "https://leakth.is/threads/checked."
+    mock_requests.head(base + "0", status_code=200)
+    mock_requests.head(base + "1", status_code=404)
+    mock_requests.head(base + "2", status_code=410)
+    # Redirects to a page that doesn't exist.
+    mock_requests.head(base + "3", status_code=301, headers={"Location": base + "removed"})
+    mock_requests.head(base + "removed", status_code=404)
+    # HEAD isn't supported, so a ranged GET is made instead.
+    mock_requests.head(base + "4", status_code=405)
+    mock_requests.get(base + "4", status_code=404)
+    mock_requests.head(base + "5", exc=ConnectTimeout)
+
+    session = session_factory()
+    # Created in the future so they're the most recent posts.
+    posts = [
+        Post(
+            native_id=f"checked.{i}", section_id=-1, title="", url=base + str(i), prefixes=[], created_by="",
+            created=datetime(2100, 1, 1) + timedelta(days=i), reply_count=0, view_count=0, body="", html="", pinned=False
+        ) for i in range(6)
+    ]
+    session.add_all(posts)
+    session.commit()
+    monkeypatch.setitem(mock_scraper.config, "check_deleted_depth", len(posts))
+    checker = DeletedPostChecker(mock_scraper)
+    checker.run()
+    ranged = [request for request in mock_requests.request_history if request.url == base + "4" and request.method == "GET"]
+    assert ranged[0].headers["Range"] == "bytes=0-0"
+
+    for post in posts:
+        session.refresh(post)
+    assert [bool(post.deleted) for post in posts] == [False, True, True, True, True, False]
+    # Failed checks aren't recorded, so the post is checked again next run.
+    assert [post.last_checked_deleted is not None for post in posts] == [True] * 5 + [False]
+
+    # Posts that were just checked, or are already deleted, aren't due again until the interval has passed.
+    now = datetime.now()
+    assert checker.get_due_posts(session, now, len(posts)) == [posts[5]]
+    interval = timedelta(minutes=mock_scraper.config["check_deleted_interval"])
+    assert checker.get_due_posts(session, now + interval * 2, len(posts)) == [posts[5], posts[0]]
+    # Each run checks the share of posts that has come due since the last run.
+    checker.last_run = now - interval / 2
+    assert checker.get_batch_size(now) == math.ceil(len(posts) / 2)
+
+    for post in posts:
+        session.delete(post)
+    session.commit()
+    session.close()
+
+def test_stylesheet_cache(requests_mock, tmp_path):
+    url = "https://leakth.is/css.php?css=prefixes"
+    css = """
+        /* Comments are skipped. */
+        .label.label--red { color: #fff; background: red }
+        .label.label--red { color: black }
+        .label--blue{background-color:rgb(0, 0, 255)}
+    """
+    # Only the first rule for a selector is kept.
+    assert build_selector_index(css) == {
+        ".label.label--red": {"color": "#fff", "background": "red"},
+        ".label--blue": {"background-color": "rgb(0, 0, 255)"}
+    }
+
+    path = str(tmp_path / "stylesheet_cache.json")
+    requests_mock.get(url, text=css, headers={"ETag": '"v1"'})
+    cache = StylesheetCache(path)
+    session = Session()
+    assert cache.get_declarations(session, [url], ".label--blue") == {"background-color": "rgb(0, 0, 255)"}
+    # Fresh entries are served without a request.
+    cache.get_index(session, url)
+    assert requests_mock.call_count == 1
+
+    # Entries are persisted, and revalidated with a conditional request once they're stale.
+    cache = StylesheetCache(path)
+    cache.entries[url]["validated"] = 0
+    requests_mock.get(url, status_code=304)
+    assert cache.get_index(session, url)[".label--blue"] == {"background-color": "rgb(0, 0, 255)"}
+    assert requests_mock.last_request.headers["If-None-Match"] == '"v1"'
+    assert cache.entries[url]["validated"] > 0
+
+    # A changed stylesheet is indexed again.
+    cache.entries[url]["validated"] = 0
+    requests_mock.get(url, text=".label--blue { color: white }", headers={"ETag": '"v2"'})
+    assert cache.get_declarations(session, [url], ".label--blue") == {"color": "white"}
+    assert StylesheetCache(path).entries[url]["etag"] == '"v2"'
+
+def test_parse_prefix(mock_scraper, mock_requests):
+    style_url = mock_scraper.base_url + "/css.php?css=test_prefix"
+    mock_requests.get(style_url, text=".label.label--test { color: #fff; background-color: #d43f3a }")
+    soup = BeautifulSoup(f"""
+        <html><head><link rel="stylesheet" href="{style_url}"></head><body>
+            <a href="/forums/hip-hop-leaks/?prefix_id[0]=1234" class="labelLink">
+                <span class="label label--test">TEST PREFIX</span>
+            </a>
+        </body></html>
+    """, "html.parser")
+    prefix_tag = soup.find("a", class_="labelLink")
+    mock_scraper.parse_prefix(soup, prefix_tag)
+
+    session = session_factory()
+    prefix = session.query(Prefix).filter_by(name="TEST PREFIX").one()
+    assert (prefix.prefix_id, prefix.text_color, prefix.bg_color) == (1234, "#fff", "#d43f3a")
+    # Known prefixes aren't parsed again.
+    requests_before = len(mock_requests.request_history)
+    mock_scraper.parse_prefix(soup, prefix_tag)
+    assert len(mock_requests.request_history) == requests_before
+    assert session.query(Prefix).filter_by(name="TEST PREFIX").count() == 1
+    session.delete(prefix)
+    session.commit()
+    session.close()
\ No newline at end of file
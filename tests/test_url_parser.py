@@ -1,5 +1,12 @@
+import hashlib
+import pytest
+import threading
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from host_policy import HostPolicy, DEFAULT_SETTINGS
+from exceptions import HostUnavailableError
 from .mocks import mock_files as files
-from url_parser import URLParser, GoFile, OnlyFilesIo
+from url_parser import URLParser, GoFile, OnlyFilesIo, AnonFiles
 
 url_parser = URLParser()
 
@@ -17,6 +24,91 @@ def _test_hosting_service(host):
         assert len(download[0]["stream"]) == file["file_length"]
         # assert download[0]["stream"] == file["file_data"]
         
+def test_streamed_download(requests_mock):
+    file = files[0]
+    file_data = file["file_data"].read()
+    file["file_data"].seek(0)
+    download_url = "https://cdn.anonfiles.com/" + file["file_name"]
+    requests_mock.get(download_url, content=file_data)
+
+    with AnonFiles().download(download_url) as stream:
+        assert len(stream) == file["file_length"]
+        assert stream.sha256 == hashlib.sha256(file_data).hexdigest()
+        assert stream.read() == file_data
+
+def test_host_page_fetched_once(requests_mock):
+    url = "https://anonfiles.com/a1b2c3/file_audio1_mp3"
+    download_url = "https://cdn-100.anonfiles.com/a1b2c3/file_audio1.mp3"
+    requests_mock.get(url, text=f'''
+        <div class="top-wrapper"><h1>file_audio1.mp3</h1></div>
+        <a id="download-url" href="{download_url}">Download</a>
+    ''')
+    host = AnonFiles()
+    assert host.parse_url(url) == ("file_audio1.mp3", download_url)
+    assert requests_mock.call_count == 1
+    # Each field can still be parsed on its own.
+    assert host.parse_file_name(url) == "file_audio1.mp3"
+    assert host.parse_download_url(url) == download_url
+
+def test_host_circuit_breaker(requests_mock):
+    url = "https://anonfiles.com/unavailable"
+    requests_mock.get(url, status_code=503)
+    policy = HostPolicy("AnonFiles", {**DEFAULT_SETTINGS, "failure_threshold": 2, "rate": 100})
+    def request():
+        with policy.limit() as outcome:
+            outcome.failed = policy.is_failure(requests.get(url))
+
+    request()
+    request()
+    assert policy.get_state()["circuit"] == "open"
+    # The host isn't contacted while the circuit is open.
+    with pytest.raises(HostUnavailableError):
+        request()
+    assert requests_mock.call_count == 2
+
+    # After the cooldown, a successful trial request closes the circuit.
+    policy.breaker.opened_at -= DEFAULT_SETTINGS["cooldown"]
+    requests_mock.get(url, status_code=200)
+    request()
+    assert policy.get_state()["circuit"] == "closed"
+
+def test_unparseable_urls():
+    # e.g. an iframe without a src.
+    assert url_parser.get_hosting_service(None) is None
+    assert url_parser.get_hosting_service("http://[anonfiles.com/a") is None
+    assert isinstance(url_parser.get_hosting_service("https://anonfiles.com/a"), AnonFiles)
+
+def test_host_queue_timeout():
+    policy = HostPolicy("congested", {**DEFAULT_SETTINGS, "max_in_flight": 1, "queue_timeout": .05, "failure_threshold": 2, "rate": 1000})
+    with policy.limit():
+        # Waiting for a slot on a healthy host doesn't count towards opening its circuit.
+        for i in range(3):
+            with pytest.raises(HostUnavailableError):
+                with policy.limit(): pass
+    assert policy.get_state()["circuit"] == "closed"
+    assert policy.get_state()["rejected"] == 3
+    with policy.limit(): pass
+
+def test_slow_host_leaves_workers_free():
+    settings = {**DEFAULT_SETTINGS, "queue_timeout": 5, "rate": 1000}
+    (slow, healthy) = (HostPolicy("slow", settings), HostPolicy("healthy", settings))
+    release = threading.Event()
+    def download(policy, wait):
+        with policy.limit():
+            if wait: release.wait(5)
+            return policy.name
+
+    # One download worker more than the slow host can occupy (its requests in flight plus those waiting for a slot).
+    with ThreadPoolExecutor(max_workers=settings["max_in_flight"] + settings["max_queued"] + 1) as executor:
+        slow_downloads = [executor.submit(download, slow, True) for i in range(6)]
+        # The slow host's extra downloads give up instead of holding workers, so the healthy host isn't held up behind them.
+        assert executor.submit(download, healthy, False).result(timeout=1) == "healthy"
+        release.set()
+        results = [download.exception() or download.result() for download in slow_downloads]
+    assert results.count("slow") == settings["max_in_flight"] + settings["max_queued"]
+    assert all([isinstance(result, HostUnavailableError) for result in results if result != "slow"])
+    assert slow.get_state()["circuit"] == "closed"
+
 def test_onlyfiles_io():
     _test_hosting_service(OnlyFilesIo())
 
@@ -4,13 +4,16 @@ import re
 import traceback
 import json
 import inspect
-from functools import wraps
+import hashlib
+from functools import wraps, lru_cache
 from time import time
-from bs4 import BeautifulSoup
 from urllib.parse import urlsplit
 from abc import ABC, abstractmethod
 from exceptions import FileNotFoundError, UnknownHostingServiceError, AuthenticationError
 from commons import assert_is_ok, get_mimetype
+from parsing import make_soup
+from spool import SpooledDownload
+from host_policy import get_policy
 from webdriver import create_chrome_driver
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.common.by import By
@@ -35,6 +38,23 @@ class Netloc:
         self.host_name = host_name
         self.domain_name = domain_name
 
+    @property
+    def key(self):
+        # Subdomains don't have to match for a URL to belong to a host (see HostingService.is_host_url).
+        return (self.host_name, self.domain_name)
+
+class HostPage:
+    """ A fetched host page. The page is only parsed once, the first time `soup` is accessed. """
+    def __init__(self, res):
+        self.res = res
+        self._soup = None
+
+    @property
+    def soup(self):
+        if self._soup is None:
+            self._soup = make_soup(self.res.content)
+        return self._soup
+
 class HostingService(ABC):
     @property
     @abstractmethod
@@ -46,20 +66,38 @@ class HostingService(ABC):
     def name(self):
         raise NotImplementedError
 
+    """ `page` is the result of `fetch_page(url)`. If it isn't passed in, it will be fetched. """
     @abstractmethod
-    def parse_download_url(self, url):
+    def parse_download_url(self, url, page=None):
         raise NotImplementedError
 
     @abstractmethod
-    def parse_file_name(self, url):
+    def parse_file_name(self, url, page=None):
         raise NotImplementedError
 
+    @property
+    def policy(self):
+        return get_policy(self.name)
+
+    def request(self, method, url, **kwargs):
+        """ Make a request to the host, subject to its HostPolicy (see host_policy.py). """
+        with self.policy.limit() as outcome:
+            res = session.request(method, url, timeout=self.policy.timeout, **kwargs)
+            outcome.failed = self.policy.is_failure(res)
+            return res
+
+    def fetch_page(self, url):
+        # Can override if necessary (i.e. file information comes from an API instead of the page)
+        return HostPage(self.request("get", url))
+
     def upload_files(self, files):
         return []
 
     def parse_url(self, url):
-        file_name = self.parse_file_name(url)
-        download_url = self.parse_download_url(url)
+        # Fetch once and extract both the file name and download url from the same page.
+        page = self.fetch_page(url)
+        file_name = self.parse_file_name(url, page)
+        download_url = self.parse_download_url(url, page)
         return (
             file_name,
             download_url
@@ -67,24 +105,29 @@ class HostingService(ABC):
 
     def download(self, download_url):
         # Can override if necessary (i.e. requires setting headers/credentials to download)
+        # The response is streamed into a SpooledDownload, so large files are never held in memory all at once.
         logger.info(f"Downloading '{download_url}'")
         t = time()
-        res = session.get(download_url)
-        assert_is_ok(res)
+        # The request slot is held until the whole body has been read.
+        with self.policy.limit() as outcome:
+            res = session.get(download_url, stream=True, timeout=self.policy.timeout)
+            outcome.failed = self.policy.is_failure(res)
+            assert_is_ok(res)
+            stream = SpooledDownload.from_response(res)
         # logger.info("Download took " + str(time() - t) + "s to complete.")
-        return res.content
+        return stream
+
+    @property
+    def host_keys(self):
+        # Can override if necessary (i.e. the service is available under several domains).
+        # The (host name, domain name) pairs that URLs belonging to the service have. Used to index Hosts.
+        return [Netloc(self.base_url).key]
 
     def is_host_url(self, url):
-        # Can override if necessary.
         # Netloc can contain subdomains (most prominently www) and many services may support urls that omit www.
         # So, the netloc should be cleaned of the subdomain so that it's just the host name.
-        netloc = Netloc(url)
-        host_netloc = Netloc(self.base_url)
         # Make sure that the host names and domain names are the same. The subdomains don't have to match.
-        return (
-            netloc.host_name == host_netloc.host_name and
-            netloc.domain_name == host_netloc.domain_name
-        )
+        return Netloc(url).key in self.host_keys
 
 def api_request(method):
     def _impl(self, *args, **kwargs):
@@ -143,7 +186,7 @@ class GoFile(HostingService):
             raise AuthenticationError(f"Authenciation failed with GoFile. Response: '{json.dumps(data)}'. Method: '{method_name}'")
 
     def make_api_request(self, *args, **kwargs):
-        res = session.request(*args, **kwargs)
+        res = self.request(*args, **kwargs)
         data = res.json()
         self.assert_ok(data)
         return data
@@ -165,12 +208,15 @@ class GoFile(HostingService):
         data = self.make_api_request("get", self.api_url + f"getContent?contentId={content_id}&token={self.api_token}&websiteToken=websiteToken")
         return data["data"]
 
-    def parse_download_url(self, url):
-        data = self.get_download_data(url)
+    def fetch_page(self, url):
+        return self.get_download_data(url)
+
+    def parse_download_url(self, url, page=None):
+        data = page or self.fetch_page(url)
         return [file["link"] for file in data["contents"].values()]
 
-    def parse_file_name(self, url):
-        data = self.get_download_data(url)
+    def parse_file_name(self, url, page=None):
+        data = page or self.fetch_page(url)
         return [file["name"] for file in data["contents"].values()]
 
 
@@ -261,21 +307,19 @@ class OnlyFilesIo(HostingService):
             uploaded_files.append(self.base_url + data["info"])
         return uploaded_files
 
-    def parse_download_url(self, url):
+    def parse_download_url(self, url, page=None):
         # It seems that this service places audio pages under the /f/{ID} route, and audio files under
         # the /get/{ID}/{FILE_NAME} route, but it's more consistent to just read the <audio> src attr
         # instead of implicitly constructing it. 
-        res = session.get(url)
-        soup = BeautifulSoup(res.content, "html.parser")
-        audio = soup.select_one("audio")
+        page = page or self.fetch_page(url)
+        audio = page.soup.select_one("audio")
         if audio is None:
             raise FileNotFoundError(url)
         return self.base_url + audio["src"]
     
-    def parse_file_name(self, url):
-        res = session.get(url)
-        soup = BeautifulSoup(res.content, "html.parser")
-        file_name = soup.select_one(".songtitle").text
+    def parse_file_name(self, url, page=None):
+        page = page or self.fetch_page(url)
+        file_name = page.soup.select_one(".songtitle").text
         return file_name
         
 
@@ -283,30 +327,25 @@ class OnlyFilesBiz(HostingService):
     name = "OnlyFiles (Biz)"
     base_url = "https://www.onlyfiles.biz/"
 
-    def parse_download_url(self, url):
-        # It seems like onlyfiles simply appends the "type" query parameter to the end of the file id, but it's unclear.
-        # To be safe, just scrape the download url.
-        res = session.get(url)
-        # assert_is_ok(res)
-        soup = BeautifulSoup(res.content, "html.parser")
-
+    def assert_exists(self, url, soup):
         # Same method used by OnlyFiles to check if file exists
         empt = soup.select_one("#name")
         if empt == None or empt.text == "":
             raise FileNotFoundError(url)
 
-        return self.base_url + soup.select_one(".player").find("source")["src"]
+    def parse_download_url(self, url, page=None):
+        # It seems like onlyfiles simply appends the "type" query parameter to the end of the file id, but it's unclear.
+        # To be safe, just scrape the download url.
+        page = page or self.fetch_page(url)
+        # assert_is_ok(page.res)
+        self.assert_exists(url, page.soup)
+        return self.base_url + page.soup.select_one(".player").find("source")["src"]
 
-    def parse_file_name(self, url):
-        res = session.get(url)
-        # assert_is_ok(res)
-        # Same method used by OnlyFiles to check if file exists
-        soup = BeautifulSoup(res.content, "html.parser")
-
-        empt = soup.select_one("#name")
-        if empt == None or empt.text == "":
-            raise FileNotFoundError(url)
-        return soup.find("meta", attrs={"name": "title"})["content"]
+    def parse_file_name(self, url, page=None):
+        page = page or self.fetch_page(url)
+        # assert_is_ok(page.res)
+        self.assert_exists(url, page.soup)
+        return page.soup.find("meta", attrs={"name": "title"})["content"]
 
 class OnlyFilesCC(HostingService):
     name = "OnlyFiles (CC)"
@@ -316,18 +355,16 @@ class OnlyFilesCC(HostingService):
         if res.status_code == 404:
             raise FileNotFoundError(url)
 
-    def parse_download_url(self, url):
-        res = session.get(url)
-        self.assert_exists(url, res)
-        soup = BeautifulSoup(res.content, "html.parser")
+    def parse_download_url(self, url, page=None):
+        page = page or self.fetch_page(url)
+        self.assert_exists(url, page.res)
         # This doesn't need to be scraped, but due to the volatile nature of the site, this is most safe.
-        return url + "/../" + soup.find("audio")["src"]
+        return url + "/../" + page.soup.find("audio")["src"]
 
-    def parse_file_name(self, url):
-        res = session.get(url)
-        self.assert_exists(url, res)
-        soup = BeautifulSoup(res.content, "html.parser")
-        return soup.select_one("#title").text
+    def parse_file_name(self, url, page=None):
+        page = page or self.fetch_page(url)
+        self.assert_exists(url, page.res)
+        return page.soup.select_one("#title").text
 
 
 class DBREE(HostingService):
@@ -363,24 +400,22 @@ class DBREE(HostingService):
         if urlsplit(res.url).path == "/index.html":
             raise FileNotFoundError(url)
 
-    def parse_download_url(self, url):
+    def parse_download_url(self, url, page=None):
         # DBREE download urls aren't static and the way they're generated is unclear.
         # Unless the way they're generated is discovered, scraping is necessary.
-        res = session.get(url)
-        assert_is_ok(res)
-        self.assert_exists(url, res)
-        soup = BeautifulSoup(res.content, "html.parser")
+        page = page or self.fetch_page(url)
+        assert_is_ok(page.res)
+        self.assert_exists(url, page.res)
         # DBREE uses protocol=relative download urls
-        return "https:" + soup.find("a", text="Download")["href"]
-
-    def parse_file_name(self, url):
-        res = session.get(url)
-        assert_is_ok(res)
-        self.assert_exists(url, res)
-        soup = BeautifulSoup(res.content, "html.parser")
-        # return soup.select_one("#detailsModalLabel").text
+        return "https:" + page.soup.find("a", text="Download")["href"]
+
+    def parse_file_name(self, url, page=None):
+        page = page or self.fetch_page(url)
+        assert_is_ok(page.res)
+        self.assert_exists(url, page.res)
+        # return page.soup.select_one("#detailsModalLabel").text
         pattern = r"Name: (.*)"
-        return re.match(pattern, soup.find("li", text=re.compile(pattern)).text).group(1)
+        return re.match(pattern, page.soup.find("li", text=re.compile(pattern)).text).group(1)
 
 class AnonFiles(HostingService):
     name = "AnonFiles"
@@ -390,18 +425,16 @@ class AnonFiles(HostingService):
         if res.status_code == 404:
             raise FileNotFoundError(url)
 
-    def parse_download_url(self, url):
+    def parse_download_url(self, url, page=None):
         # Unclear how AnonFiles generates cdn urls, so have to scrape it.
-        res = session.get(url)
-        self.assert_exists(url, res)
-        soup = BeautifulSoup(res.content, "html.parser")
-        return soup.select_one("#download-url")["href"]
+        page = page or self.fetch_page(url)
+        self.assert_exists(url, page.res)
+        return page.soup.select_one("#download-url")["href"]
 
-    def parse_file_name(self, url):
-        res = session.get(url)
-        self.assert_exists(url, res)
-        soup = BeautifulSoup(res.content, "html.parser")
-        return soup.select_one(".top-wrapper").select_one("h1").text
+    def parse_file_name(self, url, page=None):
+        page = page or self.fetch_page(url)
+        self.assert_exists(url, page.res)
+        return page.soup.select_one(".top-wrapper").select_one("h1").text
 
 Hosts = [
     OnlyFilesIo(),
@@ -412,19 +445,40 @@ Hosts = [
     GoFile()
 ]
 
+""" Identifies the current set of hosting services and the URLs they match. """
+def get_hosts_signature():
+    return hashlib.sha1(json.dumps(sorted([[Host.name, Host.host_keys] for Host in Hosts])).encode("utf-8")).hexdigest()
+
+""" Name -> hosting service, for resolving the hosting service stored on a file. """
+HostsByName = {Host.name: Host for Host in Hosts}
+
+""" (host name, domain name) -> hosting service, for every service in Hosts. """
+HostIndex = {key: Host for Host in Hosts for key in Host.host_keys}
+
+""" Get the hosting service that a URL belongs to, or None. The same URLs are resolved repeatedly (e.g. when serializing
+    files), so results are memoized. """
+def resolve_hosting_service(url):
+    # Scraped URLs can be missing (e.g. an iframe without a src), which nothing should match.
+    if not isinstance(url, str): return None
+    return resolve_url_hosting_service(url)
+
+@lru_cache(maxsize=4096)
+def resolve_url_hosting_service(url):
+    try:
+        key = Netloc(url).key
+    except Exception as e:
+        # Invalid URL. Nothing should match it.
+        logger.warning(f"Could not parse the host of URL '{url}' ({type(e).__name__}: {e}).")
+        return None
+    return HostIndex.get(key)
+    # logger.debug(f"No service implementation is associated with '{url}'.")
+
 class URLParser:
     def __init__(self):
         pass
 
     def get_hosting_service(self, url):
-        for Host in Hosts:
-            try:
-                if Host.is_host_url(url):
-                    return Host
-            except:
-                # Invalid URL. Skip parsing because nothing should match it.
-                break
-        # logger.debug(f"No service implementation is associated with '{url}'.")
+        return resolve_hosting_service(url)
 
     """
     def parse_download_url(self, url):
@@ -435,12 +489,11 @@ class URLParser:
 
     def download(self, url):
         hosting_service = self.get_hosting_service(url)
+        files = []
         try:
             if hosting_service is None:
                 raise UnknownHostingServiceError(url)
 
-            files = []
-
             (file_names, download_urls) = hosting_service.parse_url(url)
             if not isinstance(file_names, list):
                 file_names = [file_names]
@@ -455,6 +508,9 @@ class URLParser:
                 })
             return files
         except Exception as e:
+            # Release any files that were already spooled for this URL.
+            for file in files:
+                file["stream"].close()
             # Either file doesn't exist (FileNotFoundError) or something went wrong (e.g. connection was refused).
             # logger.error(e)
             return [{
@@ -427,6 +427,10 @@ class Section extends QueryParamsPageComponent {
       "popular",
       "active"
     ];
+    // Only offered while searching, since there's nothing to rank posts against otherwise.
+    this.SORT_BY_SEARCH = [
+      "relevance"
+    ];
     // Used when query param is not specified.
     this.SORT_BY_DEFAULT = "latest"
   }
@@ -745,6 +749,14 @@ class Section extends QueryParamsPageComponent {
   getQuery() {
     return qs.parse(this.props.location.search, {ignoreQueryPrefix: true});
   }
+  getSortOptions() {
+    return this.props.searchQuery ? [...this.SORT_BY, ...this.SORT_BY_SEARCH] : this.SORT_BY;
+  }
+  getSort() {
+    // The API falls back to the default for sorts that don't apply (e.g. relevance without a search query).
+    const sort = this.getQuery().sort;
+    return this.getSortOptions().includes(sort) ? sort : this.SORT_BY_DEFAULT;
+  }
   getTotalPages() {
     return this.state.posts === null ? null : this.state.posts.pages
   }
@@ -1055,8 +1067,8 @@ class Section extends QueryParamsPageComponent {
                     </Form.Group>
                     <Form.Group className="px-3">
                       <Form.Label>Sort by:</Form.Label>
-                      <Form.Control className="sort-select custom-select custom-select-sm" as="select" onChange={this.updateSort} value={this.getQuery().sort || this.SORT_BY_DEFAULT}>
-                        {this.SORT_BY.map((option) => <option key={option} value={option}>{option}</option>)}
+                      <Form.Control className="sort-select custom-select custom-select-sm" as="select" onChange={this.updateSort} value={this.getSort()}>
+                        {this.getSortOptions().map((option) => <option key={option} value={option}>{option}</option>)}
                       </Form.Control>
                     </Form.Group>
                     <Form.Group className="d-inline-block px-3">
@@ -1077,8 +1089,8 @@ class Section extends QueryParamsPageComponent {
                     </Form.Group>
                   </Dropdown.Menu>
                 </Dropdown>
-                <Form.Control className="d-none sort-select custom-select custom-select-sm w-auto" as="select" onChange={this.updateSort} value={this.getQuery().sort || this.SORT_BY_DEFAULT}>
-                  {this.SORT_BY.map((option) => <option key={option} value={option}>{option}</option>)}
+                <Form.Control className="d-none sort-select custom-select custom-select-sm w-auto" as="select" onChange={this.updateSort} value={this.getSort()}>
+                  {this.getSortOptions().map((option) => <option key={option} value={option}>{option}</option>)}
                 </Form.Control>
               </div>
             )